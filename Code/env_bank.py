@@ -0,0 +1,168 @@
+"""Environment banks: the test and training MDPs of run_IRD.py generated once and saved to a compressed .npz file.
+
+Each MDP is generated from its own seed, so it doesn't depend on the other MDPs of the bank. Gridworlds store their
+walls, start state, goals and feature matrix, bandits their feature matrix. Loading rebuilds the MDPs without
+recomputing their features. Usage:
+
+    python env_bank.py --mdp_type gridworld --height 52 --width 52 --num_test_envs 100 --num_train_envs 100 \\
+        --out data/env_banks/gridworld-52.npz
+    python run_IRD.py -c greedy_discrete --env_bank data/env_banks/gridworld-52.npz ...
+"""
+
+import argparse
+import random
+
+import numpy as np
+
+from gridworld import GridworldMdp, GridworldMdpWithDistanceFeatures, NStateMdpGaussianFeatures
+from utils import write_atomically
+
+
+# Arguments of run_IRD.py that the MDPs of a bank depend on. Loading checks that they agree.
+GRIDWORLD_PARAMS = ['height', 'width', 'feature_dim', 'dist_scale', 'linear_features', 'repeated_obj',
+                    'num_obj_if_repeated', 'decorrelate_test_feat']
+BANDITS_PARAMS = ['feature_dim', 'num_states']
+
+
+def get_env_seeds(mdp_type, seed, num_test_envs, num_train_envs):
+    """Returns the seeds of the test and training MDPs of a bank. Bandits use the seeds of run_IRD.py, so that they
+    have the same features as the bandits it generates. Gridworld seeds are distinct within a bank."""
+    if mdp_type == 'bandits':
+        test_seeds = [seed + i * 50 + 100 for i in range(num_test_envs)]
+        train_seeds = [seed + i * 50 for i in range(num_train_envs)]
+    else:
+        test_seeds = [(seed * 1000003 + 2 * i + 1) % 2**32 for i in range(num_test_envs)]
+        train_seeds = [(seed * 1000003 + 2 * i) % 2**32 for i in range(num_train_envs)]
+    return np.array(test_seeds, dtype=np.int64), np.array(train_seeds, dtype=np.int64)
+
+
+def generate_gridworld(args, env_seed, decorrelate=False):
+    """Generates a gridworld like run_IRD.py, after seeding Python's and NumPy's random generators with env_seed."""
+    random.seed(int(env_seed))
+    np.random.seed(env_seed)
+    grid, goals = GridworldMdp.generate_random(
+        args, args.height, args.width, 0.35, args.feature_dim, None, living_reward=-0.01, print_grid=False,
+        decorrelate=decorrelate)
+    return GridworldMdpWithDistanceFeatures(grid, goals, args, args.dist_scale, living_reward=-0.01, noise=0)
+
+
+def generate_bandits(args, env_seed):
+    return NStateMdpGaussianFeatures(num_states=args.num_states, rewards=np.zeros(args.feature_dim), start_state=0,
+                                     preterminal_states=[], feature_dim=args.feature_dim,
+                                     num_states_reachable=args.num_states, SEED=int(env_seed))
+
+
+def get_gridworld_arrays(mdps):
+    """Returns the arrays of a bank that describe the gridworlds mdps."""
+    max_objects = max(len(objects) for mdp in mdps for _, _, objects in mdp.goals)
+    goal_objects = np.full([len(mdps), len(mdps[0].goals), max_objects], -1, dtype=np.int32)
+    for n, mdp in enumerate(mdps):
+        for g, (_, _, objects) in enumerate(mdp.goals):
+            goal_objects[n, g, :len(objects)] = objects
+    return {
+        'walls': np.array([mdp.walls for mdp in mdps], dtype=bool),
+        'start_states': np.array([mdp.start_state for mdp in mdps], dtype=np.int32),
+        'goal_positions': np.array([[(x, y) for x, y, _ in mdp.goals] for mdp in mdps], dtype=np.int32),
+        'goal_values': np.array([[mdp.grid[y][x] for x, y, _ in mdp.goals] for mdp in mdps], dtype=np.int32),
+        'goal_objects': goal_objects,
+        'feature_matrices': np.array([mdp.feature_matrix for mdp in mdps]),
+    }
+
+
+def build_gridworlds(bank, prefix, args):
+    """Rebuilds the gridworlds stored in bank under prefix without recomputing their features."""
+    mdps = []
+    for n in range(len(bank[prefix + 'walls'])):
+        grid = [['X' if wall else ' ' for wall in row] for row in bank[prefix + 'walls'][n]]
+        x, y = bank[prefix + 'start_states'][n]
+        grid[y][x] = 'A'
+        goals = []
+        for (x, y), value, objects in zip(bank[prefix + 'goal_positions'][n], bank[prefix + 'goal_values'][n],
+                                          bank[prefix + 'goal_objects'][n]):
+            grid[y][x] = int(value)
+            goals.append((int(x), int(y), [int(obj) for obj in objects if obj >= 0]))
+        mdps.append(GridworldMdpWithDistanceFeatures(grid, goals, args, args.dist_scale, living_reward=-0.01, noise=0,
+                                                     feature_matrix=bank[prefix + 'feature_matrices'][n]))
+    return mdps
+
+
+def build_bandits(bank, prefix, args):
+    """Rebuilds the bandits stored in bank under prefix without drawing their features again."""
+    return [NStateMdpGaussianFeatures(num_states=args.num_states, rewards=np.zeros(args.feature_dim), start_state=0,
+                                      preterminal_states=[], feature_dim=args.feature_dim,
+                                      num_states_reachable=args.num_states, SEED=int(env_seed),
+                                      feature_matrix=feature_matrix)
+            for env_seed, feature_matrix in zip(bank[prefix + 'seeds'], bank[prefix + 'feature_matrices'])]
+
+
+def write_env_bank(path, args, num_test_envs, num_train_envs):
+    """Generates num_test_envs test and num_train_envs training MDPs of args.mdp_type and writes them to path."""
+    test_seeds, train_seeds = get_env_seeds(args.mdp_type, args.seed, num_test_envs, num_train_envs)
+    if args.mdp_type == 'gridworld':
+        params = GRIDWORLD_PARAMS
+        test_mdps = [generate_gridworld(args, env_seed, args.decorrelate_test_feat) for env_seed in test_seeds]
+        train_mdps = [generate_gridworld(args, env_seed) for env_seed in train_seeds]
+        get_arrays = get_gridworld_arrays
+    elif args.mdp_type == 'bandits':
+        params = BANDITS_PARAMS
+        test_mdps = [generate_bandits(args, env_seed) for env_seed in test_seeds]
+        train_mdps = [generate_bandits(args, env_seed) for env_seed in train_seeds]
+        get_arrays = lambda mdps: {'feature_matrices': np.array([mdp.feature_matrix for mdp in mdps])}
+    else:
+        raise ValueError('Unknown MDP type: ' + str(args.mdp_type))
+
+    arrays = {'mdp_type': np.array(args.mdp_type), 'test_seeds': test_seeds, 'train_seeds': train_seeds}
+    for param in params:
+        arrays['param_' + param] = np.array(getattr(args, param))
+    for prefix, mdps in [('test_', test_mdps), ('train_', train_mdps)]:
+        for name, array in get_arrays(mdps).items():
+            arrays[prefix + name] = array
+    write_atomically(path, lambda f: np.savez_compressed(f, **arrays))
+
+
+def load_env_bank(path, args):
+    """Returns the first args.num_test_envs test MDPs and args.num_experiments training MDPs of the bank at path.
+    Raises ValueError if the bank's MDPs were generated with different args or there are too few of them."""
+    with np.load(path) as bank:
+        bank = dict(bank)
+    if str(bank['mdp_type']) != args.mdp_type:
+        raise ValueError('Environment bank has MDP type {t}'.format(t=bank['mdp_type']))
+    params = GRIDWORLD_PARAMS if args.mdp_type == 'gridworld' else BANDITS_PARAMS
+    for param in params:
+        if bank['param_' + param] != getattr(args, param):
+            raise ValueError('Environment bank was generated with {p}={v}'.format(p=param, v=bank['param_' + param]))
+    if len(bank['test_seeds']) < args.num_test_envs or len(bank['train_seeds']) < args.num_experiments:
+        raise ValueError('Environment bank has only {n} test and {m} training MDPs'.format(
+            n=len(bank['test_seeds']), m=len(bank['train_seeds'])))
+
+    for name in list(bank.keys()):
+        if name.startswith('test_'):
+            bank[name] = bank[name][:args.num_test_envs]
+        elif name.startswith('train_'):
+            bank[name] = bank[name][:args.num_experiments]
+    build_mdps = build_gridworlds if args.mdp_type == 'gridworld' else build_bandits
+    return build_mdps(bank, 'test_', args), build_mdps(bank, 'train_', args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--out', type=str, required=True) # Path of the .npz file
+    parser.add_argument('--num_test_envs', type=int, default=100)
+    parser.add_argument('--num_train_envs', type=int, default=100) # At least num_experiments of the runs using the bank
+    # Same as in run_IRD.py
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--mdp_type', type=str, default='gridworld')
+    parser.add_argument('--num_states', type=int, default=100)
+    parser.add_argument('--linear_features', type=int, default=1)
+    parser.add_argument('--feature_dim', type=int, default=20)
+    parser.add_argument('--dist_scale', type=float, default=0.2)
+    parser.add_argument('--height', type=int, default=12)
+    parser.add_argument('--width', type=int, default=12)
+    parser.add_argument('--repeated_obj', type=int, default=0)
+    parser.add_argument('--num_obj_if_repeated', type=int, default=50)
+    parser.add_argument('--decorrelate_test_feat', type=int, default=1)
+    args = parser.parse_args()
+
+    write_env_bank(args.out, args, args.num_test_envs, args.num_train_envs)
+    print('Wrote {n} test and {m} training MDPs to {path}'.format(
+        n=args.num_test_envs, m=args.num_train_envs, path=args.out))
@@ -0,0 +1,71 @@
+import argparse
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from env_bank import get_env_seeds, generate_gridworld, generate_bandits, write_env_bank, load_env_bank
+
+
+def make_args(**kwargs):
+    args = argparse.Namespace(
+        seed=1, mdp_type='gridworld', num_states=10, linear_features=1, feature_dim=4, dist_scale=0.2, height=7,
+        width=7, repeated_obj=0, num_obj_if_repeated=6, decorrelate_test_feat=1, num_test_envs=3, num_experiments=2)
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
+
+
+class TestEnvBank(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'bank.npz')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assert_same_gridworld(self, mdp, other):
+        self.assertEqual(mdp.grid, other.grid)
+        self.assertEqual(mdp.walls, other.walls)
+        self.assertEqual(mdp.goals, other.goals)
+        self.assertEqual(mdp.start_state, other.start_state)
+        np.testing.assert_array_equal(mdp.feature_matrix, other.feature_matrix)
+
+    def test_gridworlds(self):
+        for repeated_obj in [0, 1]:
+            args = make_args(repeated_obj=repeated_obj)
+            write_env_bank(self.path, args, 4, 3)
+            test_mdps, train_mdps = load_env_bank(self.path, args)
+            self.assertEqual((len(test_mdps), len(train_mdps)), (3, 2))
+
+            test_seeds, train_seeds = get_env_seeds('gridworld', args.seed, 3, 2)
+            for mdp, env_seed in zip(test_mdps, test_seeds):
+                self.assert_same_gridworld(mdp, generate_gridworld(args, env_seed, args.decorrelate_test_feat))
+            for mdp, env_seed in zip(train_mdps, train_seeds):
+                self.assert_same_gridworld(mdp, generate_gridworld(args, env_seed))
+
+    def test_bandits(self):
+        args = make_args(mdp_type='bandits')
+        write_env_bank(self.path, args, 3, 2)
+        test_mdps, train_mdps = load_env_bank(self.path, args)
+        test_seeds, train_seeds = get_env_seeds('bandits', args.seed, 3, 2)
+        for mdp, env_seed in zip(test_mdps + train_mdps, list(test_seeds) + list(train_seeds)):
+            other = generate_bandits(args, env_seed)
+            np.testing.assert_array_equal(mdp.feature_matrix, other.feature_matrix)
+            np.testing.assert_array_equal(mdp.get_features(5), other.get_features(5))
+            self.assertEqual(mdp.SEED, other.SEED)
+
+    def test_mismatch(self):
+        write_env_bank(self.path, make_args(), 3, 2)
+        with self.assertRaises(ValueError):
+            load_env_bank(self.path, make_args(dist_scale=0.5))
+        with self.assertRaises(ValueError):
+            load_env_bank(self.path, make_args(num_experiments=3))
+        with self.assertRaises(ValueError):
+            load_env_bank(self.path, make_args(mdp_type='bandits'))
+
+
+if __name__ == '__main__':
+    unittest.main()
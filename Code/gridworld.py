@@ -190,12 +190,18 @@ class NStateMdpGaussianFeatures(NStateMdp):
     -num_states_reachable: Integer k <= N which we may change between training and test MDP.
     -SEED
     """
-    def __init__(self, num_states, rewards, start_state, preterminal_states, feature_dim, num_states_reachable, SEED=1):
+    def __init__(self, num_states, rewards, start_state, preterminal_states, feature_dim, num_states_reachable, SEED=1,
+                 feature_matrix=None):
+        """feature_matrix: Features of each state drawn earlier with the same SEED (see env_bank.py). If given, they
+        are used instead of being drawn again."""
         self.SEED = SEED
         super(NStateMdpGaussianFeatures, self).__init__(num_states, rewards, start_state, preterminal_states)
         self.feature_dim = feature_dim
         self.num_states_reachable = num_states_reachable
-        self.populate_features()
+        if feature_matrix is None:
+            self.populate_features()
+        else:
+            self.set_feature_matrix(feature_matrix)
         self.type = 'bandits'
         # self.populate_reward
 
@@ -213,6 +219,14 @@ class NStateMdpGaussianFeatures(NStateMdp):
             self.features[state] = features
             self.feature_matrix[state,:] = np.array(features)
 
+    def set_feature_matrix(self, feature_matrix):
+        """Stores features drawn earlier by populate_features."""
+        self.SEED += 1
+        self.feature_matrix = np.array(feature_matrix, dtype=float)
+        self.features = {}
+        for state in self.get_states():
+            self.features[state] = self.feature_matrix[state,:]
+
     def get_features(self, state):
         return self.features[state]
 
@@ -665,16 +679,31 @@ class GridworldMdpWithFeatures(GridworldMdp):
 
 class GridworldMdpWithDistanceFeatures(GridworldMdpWithFeatures):
     """Features are based on distance to places with reward."""
-    def __init__(self, grid, goals, args, dist_scale=0.5, living_reward=-0.01, noise=0, rewards=None):
+    def __init__(self, grid, goals, args, dist_scale=0.5, living_reward=-0.01, noise=0, rewards=None,
+                 feature_matrix=None):
+        """feature_matrix: Features computed earlier by populate_features_and_start_state for the same grid, goals
+        and args (see env_bank.py). If given, they are used instead of being computed again."""
         self.dist_scale = dist_scale
         self.goals = goals
+        self.feature_matrix = feature_matrix
         # self.feature_weights = None
         self.linear_features = args.linear_features
         super(GridworldMdpWithDistanceFeatures, self).__init__(
             grid, args, living_reward=-0.01, noise=0)
 
     def populate_features(self):
-        self.populate_features_and_start_state()
+        if self.feature_matrix is None:
+            self.populate_features_and_start_state()
+        else:
+            self.populate_start_state()
+
+    def populate_start_state(self):
+        """Sets self.start_state to the position of 'A' in the grid."""
+        self.start_state = None
+        for y in range(len(self.grid)):
+            for x in range(len(self.grid[0])):
+                if self.grid[y][x] == 'A':
+                    self.start_state = (x, y)
 
     def populate_features_and_start_state(self):
         """Sets self.feature_matrix and self.start_state based on grid.
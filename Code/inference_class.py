@@ -2,19 +2,21 @@ import numpy as np
 
 
 class Inference(object):
-    def __init__(self, mdp, env, beta, reward_space_true, reward_space_proxy):
+    def __init__(self, mdp, env, beta, reward_space_true, reward_space_proxy, log_prior_dtype=np.float64):
         """
         :param env: Environment object or subclass
         :param beta: Rationality constant for proxy reward selection
         :param reward_space_proxy: List of proxy reward functions (which should be 1-dim np arrays)
         :param reward_space_true: List of true reward functions (which should be 1-dim np arrays)
+        :param log_prior_dtype: dtype the log prior is stored in
         """
         self.mdp = mdp
         self.env = env
         self.beta = beta
         self.reward_space_proxy = reward_space_proxy
         self.reward_space_true = reward_space_true
-        self.true_reward_matrix = self.reward_space_true
+        self.log_prior_dtype = log_prior_dtype
+        self.support_version = 0
         self.reset_prior()
         self.make_reward_to_index_dict()
 
@@ -22,20 +24,118 @@ class Inference(object):
         """Calculates posterior for given query and answer and replaces prior with the outcome. Deletes prior_avg.
         If true_posterior is given, it replaces the prior directly and updates the prior_avg."""
         if true_log_posterior is not None:
-            self.log_prior = true_log_posterior
-            self.prior = np.exp(true_log_posterior)
+            self.log_prior = np.asarray(true_log_posterior, dtype=self.log_prior_dtype)
+            self.prior_cdf = None
         # TODO(rohinmshah): Can the elif case be removed? (soerenmind): It would break if query is None
         elif len(query) == 0: # Do nothing for empty query
             return
         else:
             raise ValueError('inference.get_full_posterior shouldnt be used')
-            self.prior = self.get_full_posterior(query, answer)
+            self.log_prior = np.log(self.get_full_posterior(query, answer))
+
+    @property
+    def prior(self):
+        """The prior is computed from log_prior on demand rather than stored next to it."""
+        return np.exp(self.log_prior)
 
     def reset_prior(self):
-        '''Resets to uniform prior'''
+        '''Resets to uniform prior over the full true reward space'''
         num_rewards = len(self.reward_space_true)
-        self.log_prior = np.tile(-np.log(num_rewards), num_rewards)
-        self.prior = np.exp(self.log_prior)
+        self.true_reward_matrix = self.reward_space_true
+        self.support_idx = None
+        self.discarded_mass = 0.
+        self.support_version += 1
+        self.log_prior = np.full(num_rewards, -np.log(num_rewards), dtype=self.log_prior_dtype)
+        self.prior_cdf = None
+        self.uniform_cdf = None
+
+    def prune_prior(self, eps=0., top_k=0):
+        """Drops true rewards with negligible prior mass so that later posterior computations only use the support.
+        true_reward_matrix and log_prior are restricted to the support (renormalized), support_idx holds the indeces
+        of the support in reward_space_true and discarded_mass the total prior mass dropped since reset_prior.
+        :param eps: Drop true rewards with prior probability below eps (0: no threshold). The most likely true reward is
+            always kept.
+        :param top_k: Keep at most the top_k true rewards by prior mass (0: no limit).
+        """
+        prior = self.prior
+        probs = prior / prior.sum()
+        keep = probs >= eps
+        # Never drop the whole support
+        keep[np.argmax(probs)] = True
+        if top_k and keep.sum() > top_k:
+            keep[:] = False
+            keep[np.argpartition(-probs, top_k - 1)[:top_k]] = True
+        if keep.all():
+            return
+        kept_mass = probs[keep].sum()
+        self.discarded_mass = 1. - (1. - self.discarded_mass) * kept_mass
+        self.support_idx = np.flatnonzero(keep) if self.support_idx is None else self.support_idx[keep]
+        self.support_version += 1
+        self.true_reward_matrix = self.reward_space_true[self.support_idx]
+        self.log_prior = self.log_prior[keep] - np.log(prior[keep].sum(), dtype=self.log_prior_dtype)
+        self.prior_cdf = None
+        self.uniform_cdf = None
+
+    def get_prior_state(self):
+        """Returns the prior and its support for checkpoints, see set_prior_state."""
+        return {'log_prior': self.log_prior, 'support_idx': self.support_idx, 'discarded_mass': self.discarded_mass}
+
+    def set_prior_state(self, state):
+        """Restores a prior and its support returned by get_prior_state."""
+        self.reset_prior()
+        if state['support_idx'] is not None:
+            self.support_idx = state['support_idx']
+            self.true_reward_matrix = self.reward_space_true[self.support_idx]
+        self.discarded_mass = state['discarded_mass']
+        self.log_prior = np.asarray(state['log_prior'], dtype=self.log_prior_dtype)
+
+    def get_avg_reward_matrix(self, true_reward_idx=None):
+        """Returns the columns of avg_reward_matrix (which covers all of reward_space_true) for the given indeces into
+        true_reward_matrix, or for all of true_reward_matrix if true_reward_idx is None."""
+        if self.support_idx is None:
+            if true_reward_idx is None:
+                return self.avg_reward_matrix
+            return self.avg_reward_matrix[:, true_reward_idx]
+        if true_reward_idx is None:
+            return self.avg_reward_matrix[:, self.support_idx]
+        return self.avg_reward_matrix[:, self.support_idx[true_reward_idx]]
+
+    def sample_true_reward_idx(self, num_samples, uniform_sampling=False, return_counts=False):
+        """Samples indeces into true_reward_matrix from the prior (or uniformly). The cumulative distribution is built
+        once per prior update and reused, and draws match np.random.choice(size, p=probs, size=num_samples).
+        :param return_counts: If True, returns the unique sampled indeces and their counts instead.
+        """
+        if uniform_sampling:
+            if self.uniform_cdf is None:
+                self.uniform_cdf = self.build_cdf(np.ones(len(self.log_prior)))
+            cdf = self.uniform_cdf
+        else:
+            if self.prior_cdf is None:
+                self.prior_cdf = self.build_cdf(self.prior)
+            cdf = self.prior_cdf
+        choices = cdf.searchsorted(np.random.random_sample(num_samples), side='right')
+        if return_counts:
+            return np.unique(choices, return_counts=True)
+        return choices
+
+    def build_cdf(self, probs):
+        """Returns the normalized cumulative sum of probs the same way np.random.choice computes it."""
+        probs = np.asarray(probs, dtype=np.float64)
+        probs = probs / probs.sum()
+        cdf = probs.cumsum()
+        cdf /= cdf[-1]
+        return cdf
+
+    def get_prior_moments(self, features=None):
+        """Returns the exact mean and standard deviation of each true reward feature under the prior.
+        :param features: List of feature indeces to compute the moments for, or None for all features.
+        """
+        true_reward_matrix = self.true_reward_matrix if features is None else self.true_reward_matrix[:, features]
+        prior = self.prior
+        probs = prior / prior.sum()
+        means = np.dot(probs, true_reward_matrix)
+        variances = np.dot(probs, (true_reward_matrix - means) ** 2)
+        return means, np.sqrt(variances)
 
     def make_reward_to_index_dict(self):
         """Creates dictionary from proxy reward tuples to their index in proxy space. If index_true_space, it does the
@@ -0,0 +1,92 @@
+import numpy as np
+import unittest
+
+from inference_class import Inference
+
+
+class TestInference(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(1)
+        self.size_true, self.dim = 500, 5
+        self.reward_space_true = np.random.randint(-9, 10, size=[self.size_true, self.dim])
+        self.inference = Inference(None, None, 0.5, self.reward_space_true, np.random.randn(10, self.dim))
+        log_prior = 3 * np.random.randn(self.size_true)
+        self.inference.update_prior(None, None, log_prior - np.log(np.exp(log_prior).sum()))
+
+    def test_prior_moments(self):
+        prior = self.inference.prior
+        means, stds = self.inference.get_prior_moments()
+        np.testing.assert_allclose(means, np.average(self.reward_space_true, axis=0, weights=prior))
+        np.testing.assert_allclose(stds, np.sqrt(np.diag(np.cov(self.reward_space_true.T, aweights=prior, ddof=0))))
+
+        features = [3, 1]
+        feature_means, feature_stds = self.inference.get_prior_moments(features)
+        np.testing.assert_allclose(feature_means, means[features])
+        np.testing.assert_allclose(feature_stds, stds[features])
+
+    def test_sample_true_reward_idx(self):
+        # The draws match np.random.choice, also after the prior changes and its CDF is rebuilt
+        for _ in range(2):
+            probs = self.inference.prior / self.inference.prior.sum()
+            uniform_probs = np.full(self.size_true, 1. / self.size_true)
+            for uniform_sampling, p in [(False, probs), (True, uniform_probs)]:
+                np.random.seed(2)
+                expected = np.random.choice(self.size_true, p=p, size=1000)
+                for _ in range(2):
+                    np.random.seed(2)
+                    np.testing.assert_array_equal(
+                        self.inference.sample_true_reward_idx(1000, uniform_sampling=uniform_sampling), expected)
+                np.random.seed(2)
+                idx, counts = self.inference.sample_true_reward_idx(
+                    1000, uniform_sampling=uniform_sampling, return_counts=True)
+                expected_idx, expected_counts = np.unique(expected, return_counts=True)
+                np.testing.assert_array_equal(idx, expected_idx)
+                np.testing.assert_array_equal(counts, expected_counts)
+            self.inference.update_prior(None, None, self.inference.log_prior[::-1])
+
+    def test_prune_prior(self):
+        probs = self.inference.prior / self.inference.prior.sum()
+        self.inference.avg_reward_matrix = np.random.randn(10, self.size_true)
+        avg_reward_matrix = self.inference.avg_reward_matrix
+        support_idx = np.sort(np.argsort(-probs)[:100])
+        self.inference.prune_prior(top_k=100)
+        np.testing.assert_array_equal(self.inference.support_idx, support_idx)
+        np.testing.assert_array_equal(self.inference.true_reward_matrix, self.reward_space_true[support_idx])
+        np.testing.assert_allclose(self.inference.prior, probs[support_idx] / probs[support_idx].sum())
+        self.assertAlmostEqual(self.inference.discarded_mass, 1 - probs[support_idx].sum())
+        np.testing.assert_array_equal(self.inference.get_avg_reward_matrix(), avg_reward_matrix[:, support_idx])
+        np.testing.assert_array_equal(
+            self.inference.get_avg_reward_matrix([2, 0]), avg_reward_matrix[:, support_idx[[2, 0]]])
+
+        # A second pruning narrows the support further
+        pruned_probs = self.inference.prior
+        keep = pruned_probs >= 0.01
+        self.assertTrue(0 < keep.sum() < len(keep))
+        state = self.inference.get_prior_state()
+        self.inference.prune_prior(eps=0.01)
+        np.testing.assert_array_equal(self.inference.support_idx, support_idx[keep])
+        np.testing.assert_allclose(self.inference.prior, pruned_probs[keep] / pruned_probs[keep].sum())
+        self.assertAlmostEqual(self.inference.discarded_mass, 1 - probs[support_idx[keep]].sum())
+        means, stds = self.inference.get_prior_moments()
+        np.testing.assert_allclose(means, np.average(self.reward_space_true[support_idx[keep]], axis=0,
+                                                     weights=probs[support_idx[keep]]))
+
+        self.inference.set_prior_state(state)
+        np.testing.assert_array_equal(self.inference.support_idx, support_idx)
+        np.testing.assert_allclose(self.inference.prior, probs[support_idx] / probs[support_idx].sum())
+
+        self.inference.reset_prior()
+        self.assertIsNone(self.inference.support_idx)
+        self.assertEqual(len(self.inference.log_prior), self.size_true)
+        self.assertEqual(self.inference.discarded_mass, 0.)
+
+        # A threshold above the largest mass of a flat prior keeps the most likely true reward
+        self.inference.prune_prior(eps=0.05)
+        self.assertEqual(len(self.inference.support_idx), 1)
+        np.testing.assert_array_equal(self.inference.log_prior, [0.])
+        self.assertAlmostEqual(self.inference.discarded_mass, 1 - 1. / self.size_true)
+        np.testing.assert_array_equal(self.inference.sample_true_reward_idx(10), np.zeros(10))
+
+
+if __name__ == '__main__':
+    unittest.main()
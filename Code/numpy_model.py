@@ -0,0 +1,391 @@
+import numpy as np
+import time
+from scipy.special import logsumexp, entr
+
+
+class NumpyNoPlanningModel(object):
+    """NumPy implementation of NoPlanningModel (and its cached and batched variants).
+
+    Has the same constructor and compute() interface as the TF models so that Query_Chooser.get_model can return it
+    instead. It needs no session, placeholders or feed dicts, which dominate the cost of evaluating one small query
+    with TF. Matrix products are done by NumPy's (multithreaded) BLAS.
+
+    Supported outputs: 'entropy', 'query_neg_entropy', 'total_variation', 'log_posterior', 'posterior',
+    'true_log_posterior', 'true_posterior', 'true_entropy', 'post_avg' and, for batched models, 'objectives',
+    'best_candidate' and 'best_objective'.
+    """
+    output_names = ['entropy', 'query_neg_entropy', 'total_variation', 'log_posterior', 'posterior',
+                    'true_log_posterior', 'true_posterior', 'true_entropy', 'post_avg',
+                    'objectives', 'best_candidate', 'best_objective']
+
+    def __init__(self, feature_dim, gamma, query_size, discretization_size,
+                 true_reward_space_size, num_unknown, beta, beta_planner,
+                 objective, lr, discrete, optimize, args, cache_likelihoods=False, batched=False):
+        assert discrete and not optimize, 'NumpyNoPlanningModel only evaluates discrete queries'
+        self.feature_dim = feature_dim
+        self.K = query_size
+        self.beta = beta
+        self.objective = objective
+        self.args = args
+        self.cache_likelihoods = cache_likelihoods
+        self.batched = batched
+        self.avg_reward_cache = None
+        # Random state answers are sampled from. Query_Chooser.get_model replaces it with its answer_random_state,
+        # which is seeded per experiment.
+        self.answer_random_state = np.random
+        self.true_reward_matrix, self.true_reward_matrix_float = None, None
+        self.log_prior, self.prior, self.prior_entropy = None, None, None
+        # Stream over chunks of this many true rewards when the true reward space is larger (0: never)
+        self.true_space_chunk_size = args.true_space_chunk_size
+
+    def initialize(self, sess):
+        pass
+
+    def load_likelihood_cache(self, sess, avg_reward_matrix):
+        """Stores a [size_proxy, size_true] matrix of expected true rewards. Queries are then given as indeces."""
+        self.avg_reward_cache = avg_reward_matrix
+
+    def get_true_reward_matrix_float(self, true_reward_matrix):
+        """Casts the true reward matrix to float once per matrix instead of once per query."""
+        if true_reward_matrix is not self.true_reward_matrix:
+            self.true_reward_matrix = true_reward_matrix
+            self.true_reward_matrix_float = np.asarray(true_reward_matrix, dtype=np.float32)
+        return self.true_reward_matrix_float
+
+    def get_prior(self, log_prior):
+        """Returns the prior and its entropy, computed once per log prior instead of once per query."""
+        if log_prior is not self.log_prior:
+            self.log_prior = log_prior
+            self.prior = np.exp(log_prior)
+            self.prior_entropy = entr(self.prior).sum()
+        return self.prior, self.prior_entropy
+
+    def compute(self, outputs, sess, mdp, query=None, log_prior=None, weight_inits=None, feature_expectations_input=None,
+                gradient_steps=0, gradient_logging_outputs=[], true_reward=None, true_reward_matrix=None, lr=None):
+        """Calculates the values specified in outputs and returns them. Takes the same arguments as Model.compute,
+        where query are indeces into the proxy space if the model uses the likelihood cache.
+
+        :param outputs: List of strings, each specifying a value to compute.
+        :return: List of the same length as parameter `outputs`.
+        """
+        if gradient_steps > 0:
+            raise ValueError('NumpyNoPlanningModel cannot take gradient steps')
+        for name in outputs:
+            if name not in self.output_names:
+                raise ValueError("Unknown op name: " + str(name))
+
+        if self.true_space_chunk_size and len(log_prior) > self.true_space_chunk_size:
+            return self.compute_chunked(outputs, query, log_prior, feature_expectations_input, true_reward,
+                                        true_reward_matrix)
+
+        if self.cache_likelihoods:
+            avg_reward_matrix = self.avg_reward_cache[np.asarray(query)]
+        else:
+            true_reward_matrix_float = self.get_true_reward_matrix_float(true_reward_matrix)
+            avg_reward_matrix = np.dot(feature_expectations_input, true_reward_matrix_float.T)
+
+        log_P_q_z = self.get_log_answer_likelihoods(avg_reward_matrix)
+        P_q_z = np.exp(log_P_q_z)
+        prior, prior_entropy = self.get_prior(log_prior)
+        Z_q = np.dot(P_q_z, prior)[..., np.newaxis]
+        values = {}
+
+        measures = set(outputs)
+        if self.batched:
+            measures.add(self.objective)
+        if 'entropy' in measures:
+            # Expected posterior entropy H(W|Q) = H(W) + H(Q|W) - H(Q). Avoids computing the posterior per answer.
+            cond_answer_entropy = -np.dot(P_q_z * log_P_q_z, prior).sum(axis=-1)
+            answer_entropy = entr(Z_q).sum(axis=-2)
+            values['entropy'] = (prior_entropy + cond_answer_entropy)[..., np.newaxis, np.newaxis] \
+                - answer_entropy[..., np.newaxis]
+        if 'query_neg_entropy' in measures:
+            values['query_neg_entropy'] = -entr(Z_q).sum(axis=-2, keepdims=True)
+        if measures & {'total_variation', 'log_posterior', 'posterior',
+                       'true_log_posterior', 'true_posterior', 'true_entropy', 'post_avg'}:
+            log_posterior = log_P_q_z + log_prior - np.log(Z_q)
+            posterior = np.exp(log_posterior)
+            values['log_posterior'], values['posterior'] = log_posterior, posterior
+        if 'total_variation' in measures:
+            rewards = self.get_true_reward_matrix_float(true_reward_matrix)
+            post_averages = np.dot(posterior, rewards)
+            post_var = np.dot(posterior, rewards ** 2) - post_averages ** 2
+            total_variations = post_var.sum(axis=-1)
+            total_variation = (total_variations * Z_q[..., 0]).sum(axis=-1)
+            values['total_variation'] = total_variation.reshape([-1, 1, 1])
+
+        if self.batched:
+            objectives = values[self.objective].reshape(-1)
+            values['objectives'] = objectives
+            values['best_candidate'] = np.argmin(objectives)
+            values['best_objective'] = objectives.min()
+        elif measures & {'true_log_posterior', 'true_posterior', 'true_entropy', 'post_avg'}:
+            sample = self.sample_answer(feature_expectations_input, true_reward)
+            true_posterior = posterior[sample]
+            values['true_log_posterior'] = log_posterior[sample]
+            values['true_posterior'] = true_posterior
+            values['true_entropy'] = np.array([entr(true_posterior).sum()])
+            values['post_avg'] = np.dot(true_posterior, self.get_true_reward_matrix_float(true_reward_matrix))
+
+        return [values[name] for name in outputs]
+
+    def get_log_answer_likelihoods(self, avg_reward_matrix):
+        """Returns log P(q|w), the log likelihood of each answer for each true reward. Shape [..., K, size_true]"""
+        log_likelihoods = self.beta * avg_reward_matrix
+        log_likelihoods_max = log_likelihoods.max(axis=-2, keepdims=True)
+        log_Z_w = log_likelihoods_max + np.log(np.exp(log_likelihoods - log_likelihoods_max).sum(axis=-2, keepdims=True))
+        return log_likelihoods - log_Z_w
+
+    def sample_answer(self, feature_expectations_input, true_reward):
+        """Samples the answer for the true reward."""
+        avg_true_rewards = np.dot(feature_expectations_input, true_reward)
+        log_answer_probs = self.beta * avg_true_rewards
+        # Gumbel-max trick, with the same noise as the TensorFlow models
+        noise = self.answer_random_state.gumbel(size=len(log_answer_probs))
+        return np.argmax(log_answer_probs + noise)
+
+    def compute_chunked(self, outputs, query, log_prior, feature_expectations_input, true_reward, true_reward_matrix):
+        """Same as compute, but streams over chunks of true_space_chunk_size true rewards so that no [K, size_true]
+        matrix is held in memory.
+
+        A first pass accumulates the answer probabilities Z_q and, per answer, the posterior-weighted sums needed for
+        the objectives, post_avg and true_entropy. The normaliser over answers is per true reward, so chunks don't
+        interact beyond these sums. Only outputs that are posteriors over the whole true reward space (e.g.
+        'true_log_posterior') take a second pass, which concatenates their chunks.
+        """
+        chunks = [slice(start, start + self.true_space_chunk_size)
+                  for start in range(0, len(log_prior), self.true_space_chunk_size)]
+        measures = set(outputs)
+        if self.batched:
+            measures.add(self.objective)
+        need_answer = not self.batched and bool(
+            measures & {'true_log_posterior', 'true_posterior', 'true_entropy', 'post_avg'})
+        need_rewards = 'total_variation' in measures or (need_answer and 'post_avg' in measures)
+
+        # Sums over true rewards w, for each answer q: P(q) (kept as [..., K, 1] like in compute),
+        # sum_w P(q|w) P(w) w, sum_w P(q|w) P(w) w^2 and sum_w P(q|w) P(w) log(P(q|w) P(w))
+        Z_q, reward_sums, squared_reward_sums, log_joint_sums = 0., 0., 0., 0.
+        prior_entropy, cond_answer_entropy = 0., 0.
+        for chunk in chunks:
+            log_P_q_z = self.get_log_answer_likelihoods(
+                self.get_avg_reward_chunk(chunk, query, feature_expectations_input, true_reward_matrix))
+            P_q_z = np.exp(log_P_q_z)
+            prior = np.exp(log_prior[chunk])
+            weighted_P_q_z = P_q_z * prior
+            Z_q = Z_q + weighted_P_q_z.sum(axis=-1, keepdims=True)
+            if 'entropy' in measures:
+                prior_entropy += entr(prior).sum()
+                cond_answer_entropy = cond_answer_entropy - np.dot(P_q_z * log_P_q_z, prior).sum(axis=-1)
+            if need_rewards:
+                rewards = np.asarray(true_reward_matrix[chunk], dtype=np.float32)
+                reward_sums = reward_sums + np.dot(weighted_P_q_z, rewards)
+                if 'total_variation' in measures:
+                    squared_reward_sums = squared_reward_sums + np.dot(weighted_P_q_z, rewards ** 2)
+            if need_answer and 'true_entropy' in measures:
+                log_joint_sums = log_joint_sums + (weighted_P_q_z * (log_P_q_z + log_prior[chunk])).sum(axis=-1)
+
+        values = {}
+        if 'entropy' in measures:
+            answer_entropy = entr(Z_q).sum(axis=-2)
+            values['entropy'] = (prior_entropy + cond_answer_entropy)[..., np.newaxis, np.newaxis] \
+                - answer_entropy[..., np.newaxis]
+        if 'query_neg_entropy' in measures:
+            values['query_neg_entropy'] = -entr(Z_q).sum(axis=-2, keepdims=True)
+        if 'total_variation' in measures:
+            post_averages = reward_sums / Z_q
+            post_var = squared_reward_sums / Z_q - post_averages ** 2
+            total_variation = (post_var.sum(axis=-1) * Z_q[..., 0]).sum(axis=-1)
+            values['total_variation'] = total_variation.reshape([-1, 1, 1])
+
+        if self.batched:
+            objectives = values[self.objective].reshape(-1)
+            values['objectives'] = objectives
+            values['best_candidate'] = np.argmin(objectives)
+            values['best_objective'] = objectives.min()
+        elif need_answer:
+            sample = self.sample_answer(feature_expectations_input, true_reward)
+            Z_true = Z_q[sample, 0]
+            if 'post_avg' in measures:
+                values['post_avg'] = reward_sums[sample] / Z_true
+            if 'true_entropy' in measures:
+                values['true_entropy'] = np.array([np.log(Z_true) - log_joint_sums[sample] / Z_true])
+
+        full_outputs = [name for name in ['log_posterior', 'posterior', 'true_log_posterior', 'true_posterior']
+                        if name in measures]
+        if full_outputs:
+            log_posterior_chunks, true_log_posterior_chunks = [], []
+            for chunk in chunks:
+                log_P_q_z = self.get_log_answer_likelihoods(
+                    self.get_avg_reward_chunk(chunk, query, feature_expectations_input, true_reward_matrix))
+                log_posterior = log_P_q_z + log_prior[chunk] - np.log(Z_q)
+                if 'log_posterior' in measures or 'posterior' in measures:
+                    log_posterior_chunks.append(log_posterior)
+                if need_answer:
+                    true_log_posterior_chunks.append(log_posterior[sample])
+            if log_posterior_chunks:
+                values['log_posterior'] = np.concatenate(log_posterior_chunks, axis=-1)
+                values['posterior'] = np.exp(values['log_posterior'])
+            if true_log_posterior_chunks:
+                values['true_log_posterior'] = np.concatenate(true_log_posterior_chunks)
+                values['true_posterior'] = np.exp(values['true_log_posterior'])
+
+        return [values[name] for name in outputs]
+
+    def get_avg_reward_chunk(self, chunk, query, feature_expectations_input, true_reward_matrix):
+        """Returns the expected true rewards of the query's proxies for the true rewards in chunk (a slice)."""
+        if self.cache_likelihoods:
+            return self.avg_reward_cache[:, chunk][np.asarray(query)]
+        rewards = np.asarray(true_reward_matrix[chunk], dtype=np.float32)
+        return np.dot(feature_expectations_input, rewards.T)
+
+
+class IncrementalQueryEvaluator(object):
+    """Scores the extensions curr_query + [proxy] of a discrete query for many proxies at once.
+
+    Keeps the per true reward normaliser log_Z_w and the answer probabilities of the current query, so that each
+    candidate only adds its own row of log likelihoods. Adding a proxy rescales P(q|w) of the current answers by
+    Z_w / Z'_w, which takes O(size_true) exp and log evaluations per candidate instead of O(query_size * size_true).
+    The answer probabilities Z_q of the current answers still take a [query_size, size_true] matrix-vector product
+    per candidate, so the total cost per candidate remains O(query_size * size_true).
+    """
+    def __init__(self, beta, avg_reward_matrix, log_prior):
+        """
+        :param avg_reward_matrix: [len(curr_query), size_true] expected true rewards of the current query.
+        :param log_prior: Log prior over the true rewards.
+        """
+        assert len(avg_reward_matrix) > 0, 'Incremental evaluation needs a non-empty query'
+        self.beta = beta
+        self.prior = np.exp(log_prior)
+        self.prior_entropy = entr(self.prior).sum()
+        log_likelihoods = beta * np.asarray(avg_reward_matrix, dtype=np.float64)
+        self.log_Z_w = logsumexp(log_likelihoods, axis=0)
+        log_P_q_z = log_likelihoods - self.log_Z_w
+        P_q_z = np.exp(log_P_q_z)
+        # Z_q of the current answers is weighted_P_q_z @ rescale after adding a proxy
+        self.weighted_P_q_z = P_q_z * self.prior
+        # sum_q P(q|w) log P(q|w) for each true reward
+        self.P_log_P = (P_q_z * log_P_q_z).sum(axis=0)
+
+    def evaluate(self, avg_reward_matrix, measure):
+        """Returns the objective of curr_query + [proxy] for each row of avg_reward_matrix ([num_proxies, size_true]).
+        :param measure: 'entropy' or 'query_neg_entropy'
+        """
+        objectives = np.empty(len(avg_reward_matrix))
+        # Bound the [chunk, size_true] temporaries to about 10M entries
+        chunk_size = max(1, int(1e7) // len(self.prior))
+        for start in range(0, len(avg_reward_matrix), chunk_size):
+            objectives[start:start + chunk_size] = self.evaluate_chunk(
+                avg_reward_matrix[start:start + chunk_size], measure)
+        return objectives
+
+    def evaluate_chunk(self, avg_reward_matrix, measure):
+        log_likelihoods = self.beta * np.asarray(avg_reward_matrix, dtype=np.float64)
+        log_Z_w = np.logaddexp(self.log_Z_w, log_likelihoods)
+        log_rescale = self.log_Z_w - log_Z_w
+        rescale = np.exp(log_rescale)
+        log_P_new = log_likelihoods - log_Z_w
+        P_new = np.exp(log_P_new)
+
+        Z_q = np.dot(rescale, self.weighted_P_q_z.T)
+        Z_new = np.dot(P_new, self.prior)
+        answer_entropy = entr(Z_q).sum(axis=1) + entr(Z_new)
+        if measure == 'query_neg_entropy':
+            return -answer_entropy
+        elif measure == 'entropy':
+            # H(W|Q) = H(W) + H(Q|W) - H(Q), where P(q|w) of the current answers is rescaled
+            cond_answer_entropy = -np.dot(rescale * (self.P_log_P + log_rescale) + P_new * log_P_new, self.prior)
+            return self.prior_entropy + cond_answer_entropy - answer_entropy
+        else:
+            raise ValueError('Incremental evaluation not implemented for objective: ' + str(measure))
+
+
+class QueryBranchAndBound(object):
+    """Branch-and-bound search for the discrete query (set of distinct proxies) with the lowest expected posterior
+    entropy H(W|Q).
+
+    Proxies are added in index order, so every node is a partial query S whose completions use proxies after its last
+    one. Since H(Q) <= log K and the Shannon entropy is at least the min-entropy,
+        H(W|Q) >= H(W) - log K + E_w[-log max_q P(q|w)].
+    max_q P(q|w) is bounded above with the largest likelihood in S or among the remaining proxies over the smallest
+    possible normaliser: the one of S plus K - |S| times the smallest remaining likelihood. Subtrees whose bound isn't
+    below the incumbent are pruned.
+    """
+    def __init__(self, beta, avg_reward_matrix, log_prior, query_size, max_nodes=None, max_seconds=None):
+        """
+        :param avg_reward_matrix: [num_proxies, size_true] expected true rewards of all proxies.
+        :param max_nodes, max_seconds: Search budget. When it runs out, the result comes with a lower bound.
+        """
+        self.log_likelihoods = beta * np.asarray(avg_reward_matrix, dtype=np.float64)
+        self.num_proxies = len(self.log_likelihoods)
+        self.K = query_size
+        self.prior = np.exp(log_prior)
+        self.prior_entropy = entr(self.prior).sum()
+        self.max_nodes = max_nodes
+        self.max_seconds = max_seconds
+        # Largest and smallest likelihood among the proxies from index j on, for each true reward
+        self.suffix_max = np.maximum.accumulate(self.log_likelihoods[::-1], axis=0)[::-1]
+        self.suffix_min = np.minimum.accumulate(self.log_likelihoods[::-1], axis=0)[::-1]
+
+    def evaluate(self, idx):
+        """Returns H(W|Q) of the query with proxy indeces idx."""
+        log_likelihoods = self.log_likelihoods[idx]
+        log_P_q_z = log_likelihoods - logsumexp(log_likelihoods, axis=0)
+        P_q_z = np.exp(log_P_q_z)
+        cond_answer_entropy = -np.dot((P_q_z * log_P_q_z).sum(axis=0), self.prior)
+        answer_entropy = entr(np.dot(P_q_z, self.prior)).sum()
+        return self.prior_entropy + cond_answer_entropy - answer_entropy
+
+    def lower_bound(self, size, log_Z, log_max, first):
+        """Lower bound on H(W|Q) for all completions of a partial query using proxies from index `first` on.
+        :param size: Size of the partial query.
+        :param log_Z, log_max: Log normaliser and largest log likelihood of the partial query per true reward.
+        """
+        num_to_add = self.K - size
+        if num_to_add == 0:
+            return -np.inf
+        if self.num_proxies - first < num_to_add:
+            return np.inf
+        log_numerator = np.maximum(log_max, self.suffix_max[first])
+        log_denominator = np.logaddexp(log_Z, np.log(num_to_add) + self.suffix_min[first])
+        log_max_prob = np.minimum(0., log_numerator - log_denominator)
+        return self.prior_entropy - np.log(self.K) - np.dot(log_max_prob, self.prior)
+
+    def search(self, incumbent=None):
+        """Depth-first branch-and-bound.
+        :param incumbent: Optional list of proxy indeces (e.g. the greedy query) to start from.
+        :return: best_idx, best_objective, lower_bound, num_nodes. The optimality gap is best_objective - lower_bound
+            and is zero if the search finished within its budget.
+        """
+        best_idx, best_objective = None, np.inf
+        if incumbent is not None:
+            best_idx, best_objective = list(incumbent), self.evaluate(incumbent)
+        start_time = time.time()
+        num_nodes = 0
+
+        size_true = self.log_likelihoods.shape[1]
+        # Each frame is [partial query, log normaliser, largest log likelihood, next proxy to branch on]
+        stack = [[[], np.full(size_true, -np.inf), np.full(size_true, -np.inf), 0]]
+        while stack:
+            if (self.max_nodes and num_nodes >= self.max_nodes) or \
+                    (self.max_seconds and time.time() - start_time >= self.max_seconds):
+                # The unexplored subtrees are the remaining children of each frame on the stack
+                bounds = [self.lower_bound(len(idx), log_Z, log_max, first) for idx, log_Z, log_max, first in stack]
+                return best_idx, best_objective, min([best_objective] + bounds), num_nodes
+
+            frame = stack[-1]
+            idx, log_Z, log_max, first = frame
+            if self.lower_bound(len(idx), log_Z, log_max, first) >= best_objective:
+                stack.pop()
+                continue
+            frame[3] += 1
+            num_nodes += 1
+            child_idx = idx + [first]
+            if len(child_idx) == self.K:
+                objective = self.evaluate(child_idx)
+                if objective < best_objective:
+                    best_idx, best_objective = child_idx, objective
+            else:
+                log_likelihoods = self.log_likelihoods[first]
+                stack.append([child_idx, np.logaddexp(log_Z, log_likelihoods), np.maximum(log_max, log_likelihoods),
+                              first + 1])
+        return best_idx, best_objective, best_objective, num_nodes
@@ -0,0 +1,149 @@
+import argparse
+from itertools import combinations
+import numpy as np
+import tensorflow as tf
+import unittest
+
+from planner import NoPlanningModel, CachedNoPlanningModel, BatchedNoPlanningModel
+from numpy_model import NumpyNoPlanningModel, IncrementalQueryEvaluator, QueryBranchAndBound
+
+
+def make_args(**kwargs):
+    args = argparse.Namespace(log_objective=1, seed=1, compact_dtypes=0, true_space_chunk_size=0)
+    args.__dict__.update(kwargs)
+    return args
+
+
+class TestNumpyNoPlanningModel(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(1)
+        self.dim, self.query_size, self.beta = 5, 3, 0.5
+        self.size_true = 300
+        self.true_reward_matrix = np.random.randint(-9, 10, size=[self.size_true, self.dim]).astype(np.int16)
+        log_prior = np.random.randn(self.size_true)
+        self.log_prior = log_prior - np.log(np.exp(log_prior).sum())
+        self.feature_exp_matrix = np.random.randn(10, self.dim).astype(np.float32)
+        self.query = [1, 4, 7]
+        # The first proxy is by far the best for the true reward, so both models sample the same answer.
+        self.feature_exp_matrix[1] = 20 * np.ones(self.dim)
+        self.true_reward = np.ones(self.dim)
+
+    def build_models(self, objective, tf_class=NoPlanningModel, args=None, **kwargs):
+        tf.compat.v1.reset_default_graph()
+        model_args = (self.dim, 1., self.query_size, 5, None, None, self.beta, 1., objective, 0.1, True, False,
+                      args or make_args())
+        return tf_class(*model_args), NumpyNoPlanningModel(*model_args, **kwargs)
+
+    def test_outputs_match_tf(self):
+        outputs = ['true_log_posterior', 'true_entropy', 'post_avg']
+        feature_exps = self.feature_exp_matrix[self.query]
+        for objective in ['entropy', 'query_neg_entropy', 'total_variation']:
+            tf_model, np_model = self.build_models(objective)
+            with tf.compat.v1.Session() as sess:
+                tf_values = tf_model.compute(
+                    [objective] + outputs, sess, None, None, self.log_prior,
+                    feature_expectations_input=feature_exps, true_reward=self.true_reward,
+                    true_reward_matrix=self.true_reward_matrix)
+            np_values = np_model.compute(
+                [objective] + outputs, None, None, None, self.log_prior,
+                feature_expectations_input=feature_exps, true_reward=self.true_reward,
+                true_reward_matrix=self.true_reward_matrix)
+            for name, tf_value, np_value in zip([objective] + outputs, tf_values, np_values):
+                self.assertEqual(np.shape(tf_value), np.shape(np_value), name)
+                # The TF entropies shift log probabilities by 1e-4 to avoid log(0)
+                np.testing.assert_allclose(tf_value, np_value, rtol=1e-3, atol=1e-3, err_msg=name)
+
+    def test_cached_and_batched_match_tf(self):
+        avg_reward_matrix = np.dot(self.feature_exp_matrix, self.true_reward_matrix.T)
+        candidates = [[1, 4, 7], [0, 2, 3], [5, 6, 9]]
+
+        tf_model, np_model = self.build_models('entropy', CachedNoPlanningModel, cache_likelihoods=True)
+        with tf.compat.v1.Session() as sess:
+            tf_model.load_likelihood_cache(sess, avg_reward_matrix)
+            tf_entropies = [tf_model.compute(['entropy'], sess, None, query, self.log_prior)[0]
+                            for query in candidates]
+        np_model.load_likelihood_cache(None, avg_reward_matrix)
+        np_entropies = [np_model.compute(['entropy'], None, None, query, self.log_prior)[0]
+                        for query in candidates]
+        np.testing.assert_allclose(tf_entropies, np_entropies, rtol=1e-3)
+
+        tf_model, np_model = self.build_models('entropy', BatchedNoPlanningModel, batched=True)
+        feature_exps = self.feature_exp_matrix[np.array(candidates)]
+        with tf.compat.v1.Session() as sess:
+            tf_objectives, tf_best = tf_model.compute(
+                ['objectives', 'best_candidate'], sess, None, None, self.log_prior,
+                feature_expectations_input=feature_exps, true_reward_matrix=self.true_reward_matrix)
+        np_objectives, np_best = np_model.compute(
+            ['objectives', 'best_candidate'], None, None, None, self.log_prior,
+            feature_expectations_input=feature_exps, true_reward_matrix=self.true_reward_matrix)
+        np.testing.assert_allclose(tf_objectives, np_objectives, rtol=1e-3)
+        np.testing.assert_allclose(np.ravel(tf_entropies), np_objectives, rtol=1e-3)
+        self.assertEqual(tf_best, np_best)
+
+    def test_chunked_matches_unchunked(self):
+        outputs = ['log_posterior', 'true_log_posterior', 'true_posterior', 'true_entropy', 'post_avg']
+        feature_exps = self.feature_exp_matrix[self.query]
+        chunked_args = make_args(true_space_chunk_size=70)
+        for objective in ['entropy', 'query_neg_entropy', 'total_variation']:
+            _, np_model = self.build_models(objective)
+            _, chunked_model = self.build_models(objective, args=chunked_args)
+            inputs = dict(feature_expectations_input=feature_exps, true_reward=self.true_reward,
+                          true_reward_matrix=self.true_reward_matrix)
+            values = np_model.compute([objective] + outputs, None, None, None, self.log_prior, **inputs)
+            chunked_values = chunked_model.compute([objective] + outputs, None, None, None, self.log_prior, **inputs)
+            for name, value, chunked_value in zip([objective] + outputs, values, chunked_values):
+                self.assertEqual(np.shape(value), np.shape(chunked_value), name)
+                np.testing.assert_allclose(value, chunked_value, rtol=1e-5, atol=1e-6, err_msg=name)
+
+        avg_reward_matrix = np.dot(self.feature_exp_matrix, self.true_reward_matrix.T)
+        candidates = [[1, 4, 7], [0, 2, 3], [5, 6, 9]]
+        for kwargs in [dict(batched=True), dict(cache_likelihoods=True)]:
+            _, np_model = self.build_models('entropy', **kwargs)
+            _, chunked_model = self.build_models('entropy', args=chunked_args, **kwargs)
+            if 'batched' in kwargs:
+                inputs = dict(feature_expectations_input=self.feature_exp_matrix[np.array(candidates)],
+                              true_reward_matrix=self.true_reward_matrix)
+                outputs = ['objectives', 'best_candidate']
+                values = np_model.compute(outputs, None, None, None, self.log_prior, **inputs)
+                chunked_values = chunked_model.compute(outputs, None, None, None, self.log_prior, **inputs)
+            else:
+                np_model.load_likelihood_cache(None, avg_reward_matrix)
+                chunked_model.load_likelihood_cache(None, avg_reward_matrix)
+                values = [np_model.compute(['entropy'], None, None, query, self.log_prior)[0]
+                          for query in candidates]
+                chunked_values = [chunked_model.compute(['entropy'], None, None, query, self.log_prior)[0]
+                                  for query in candidates]
+            for value, chunked_value in zip(values, chunked_values):
+                np.testing.assert_allclose(value, chunked_value, rtol=1e-5)
+
+    def test_incremental_evaluator_matches_full_evaluation(self):
+        avg_reward_matrix = np.dot(self.feature_exp_matrix, self.true_reward_matrix.T)
+        curr_query = [1, 4]
+        for objective in ['entropy', 'query_neg_entropy']:
+            _, np_model = self.build_models(objective)
+            np_model.cache_likelihoods = True
+            np_model.load_likelihood_cache(None, avg_reward_matrix)
+            expected = [np_model.compute([objective], None, None, curr_query + [proxy], self.log_prior)[0][0][0]
+                        for proxy in range(len(avg_reward_matrix))]
+            evaluator = IncrementalQueryEvaluator(self.beta, avg_reward_matrix[curr_query], self.log_prior)
+            np.testing.assert_allclose(evaluator.evaluate(avg_reward_matrix, objective), expected, rtol=1e-6)
+
+    def test_branch_and_bound_finds_best_combination(self):
+        avg_reward_matrix = np.dot(self.feature_exp_matrix, self.true_reward_matrix.T)
+        search = QueryBranchAndBound(self.beta, avg_reward_matrix, self.log_prior, self.query_size)
+        objectives = {idx: search.evaluate(list(idx)) for idx in combinations(range(10), self.query_size)}
+        root_bound = search.lower_bound(0, np.full(self.size_true, -np.inf), np.full(self.size_true, -np.inf), 0)
+        self.assertLessEqual(root_bound, min(objectives.values()))
+        best_idx, best_objective, lower_bound, _ = search.search(incumbent=[0, 1, 2])
+        self.assertAlmostEqual(best_objective, min(objectives.values()))
+        self.assertEqual(tuple(best_idx), min(objectives, key=objectives.get))
+        self.assertEqual(lower_bound, best_objective)
+
+        _, best_objective, lower_bound, num_nodes = QueryBranchAndBound(
+            self.beta, avg_reward_matrix, self.log_prior, self.query_size, max_nodes=5).search()
+        self.assertEqual(num_nodes, 5)
+        self.assertLessEqual(lower_bound, min(objectives.values()) + 1e-9)
+
+
+if __name__ == '__main__':
+    unittest.main()
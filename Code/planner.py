@@ -7,10 +7,26 @@ from gridworld import Direction
 tf.compat.v1.disable_eager_execution() #needed until upgrade to save model instead of placeholder
 
 class Model(object):
+    # Batched models have a leading candidate axis on feature_expectations and return one objective per candidate.
+    batched = False
+    # Outputs that depend on the sampled answer to the query
+    answer_outputs = {'sample', 'true_posterior', 'true_log_posterior', 'true_entropy', 'post_avg'}
+
     def __init__(self, feature_dim, gamma, query_size, discretization_size,
                  true_reward_space_size, num_unknown, beta, beta_planner,
-                 objective, lr, discrete, optimize, args):
+                 objective, lr, discrete, optimize, args, batch_size=None):
+        """
+        :param batch_size: For continuous models, the number of fixed weight samples (candidates) that are planned for
+            and scored in one run. None for an unbatched model.
+        """
         self.initialized = False
+        # Random state answers are sampled from. Query_Chooser.get_model replaces it with its answer_random_state,
+        # which is seeded per experiment.
+        self.answer_random_state = np.random
+        self.batch_size = batch_size
+        if batch_size:
+            assert not discrete, 'batch_size is for continuous models'
+            self.batched = True
         self.feature_dim = feature_dim
         self.gamma = gamma
         self.query_size = query_size
@@ -45,12 +61,22 @@ class Model(object):
 
     def build_tf_graph(self, objective):
         self.name_to_op = {}
+        num_variables = len(tf.compat.v1.global_variables())
         self.build_weights()
         self.build_planner()
+        if self.batched and not self.discrete:
+            # The planner planned for all batch_size * K weights at once
+            self.feature_expectations = tf.reshape(
+                self.feature_expectations, [self.batch_size, self.K, self.feature_dim], name='batch_feature_exps')
+            self.name_to_op['feature_exps'] = self.feature_expectations
         self.build_map_to_posterior()
+        if not self.batched:
+            self.build_map_to_true_posterior()
         self.build_map_to_objective(objective)
-        # Initializing the variables
-        self.initialize_op = tf.compat.v1.global_variables_initializer()
+        if self.batched:
+            self.build_map_to_best_candidate(objective)
+        # Initializing the variables of this model only, so that the weights of other models are left as they are
+        self.initialize_op = tf.compat.v1.variables_initializer(tf.compat.v1.global_variables()[num_variables:])
 
     def build_weights(self):
         if self.discrete and self.optimize:
@@ -90,12 +116,15 @@ class Model(object):
         self.query_weights= tf.constant(
             self.proxy_reward_space, dtype=tf.float32, name="query_weights")
 
+        # Batched models have one set of fixed weights per candidate
+        fixed_shape = [self.batch_size, num_fixed] if self.batched else [num_fixed]
         # if self.optimize:
-        weight_inits = tf.random_normal([num_fixed], stddev=2)
+        # The op seed makes the initial weights independent of the ops built before, e.g. by other models
+        weight_inits = tf.random.normal(fixed_shape, stddev=2, seed=1)
         self.weights_to_train = tf.Variable(
             weight_inits, name="weights_to_train")
         self.weight_inputs = tf.compat.v1.placeholder(
-            tf.float32, shape=[num_fixed], name="weight_inputs")
+            tf.float32, shape=fixed_shape, name="weight_inputs")
         self.assign_op = self.weights_to_train.assign(self.weight_inputs)
         self.fixed_weights = self.weights_to_train
         self.name_to_op['weights_to_train'] = self.weights_to_train
@@ -108,16 +137,28 @@ class Model(object):
         # query_weights = [10, 11] and weight_inputs = [12, 13, 14, 15].
         # Then we want self.weights to be [12, 10, 13, 11, 14, 15].
         # Concatenate to get [10, 11, 12, 13, 14, 15]
-        repeated_weights = tf.stack([self.fixed_weights] * K, axis=0)
-        unordered_weights = tf.concat(
-            [self.query_weights, repeated_weights], axis=1)
-        # Then permute using gather to get the desired result.
-        # The permutation can be computed from the query [1, 3] using
-        # get_permutation_from_query.
-        self.permutation = tf.compat.v1.placeholder(tf.int32, shape=[dim])
-        self.weights = tf.gather(unordered_weights, self.permutation, axis=-1)
+        if self.batched:
+            B = self.batch_size
+            repeated_weights = tf.stack([self.fixed_weights] * K, axis=1)
+            query_weights = tf.stack([self.query_weights] * B, axis=0)
+            unordered_weights = tf.concat([query_weights, repeated_weights], axis=-1)
+            # Each candidate has its own permutation
+            self.permutation = tf.compat.v1.placeholder(tf.int32, shape=[B, dim])
+            batch_weights = tf.gather(unordered_weights, self.permutation, axis=-1, batch_dims=1)
+            # The planner sees the B * K weights as one large query
+            self.weights = tf.reshape(batch_weights, [B * K, dim])
+            self.name_to_op['weights'] = batch_weights
+        else:
+            repeated_weights = tf.stack([self.fixed_weights] * K, axis=0)
+            unordered_weights = tf.concat(
+                [self.query_weights, repeated_weights], axis=1)
+            # Then permute using gather to get the desired result.
+            # The permutation can be computed from the query [1, 3] using
+            # get_permutation_from_query.
+            self.permutation = tf.compat.v1.placeholder(tf.int32, shape=[dim])
+            self.weights = tf.gather(unordered_weights, self.permutation, axis=-1)
+            self.name_to_op['weights'] = self.weights
 
-        self.name_to_op['weights'] = self.weights
         self.name_to_op['query_weights'] = self.query_weights
 
 
@@ -131,17 +172,18 @@ class Model(object):
         # Get log likelihoods for true reward matrix
         true_reward_space_size = self.true_reward_space_size
         dim = self.feature_dim
-        self.true_reward_matrix = tf.compat.v1.placeholder(
-            tf.float32, [true_reward_space_size, dim], name="true_reward_matrix")
+        if self.args.compact_dtypes:
+            # Rewards are fed as int8 and cast in the graph instead of on the host
+            self.true_reward_matrix_input = tf.compat.v1.placeholder(
+                tf.int8, [true_reward_space_size, dim], name="true_reward_matrix_int8")
+            self.true_reward_matrix = tf.cast(self.true_reward_matrix_input, tf.float32, name="true_reward_matrix")
+        else:
+            self.true_reward_matrix_input = tf.compat.v1.placeholder(
+                tf.float32, [true_reward_space_size, dim], name="true_reward_matrix")
+            self.true_reward_matrix = self.true_reward_matrix_input
         self.log_true_reward_matrix = tf.compat.v1.log(self.true_reward_matrix, name='log_true_reward_matrix')
 
-
-        # TODO: Inefficient to recompute this matrix on every forward pass.
-        # We can cache it and feed in true reward indeces instead of true_reward_matrix. The matrix multiplication has
-        # size_proxy x size_true x feature_dim complexity. The other calculations in this map have a factor feature_dim
-        # less. However, storing this matrix takes size_proxy / feature_dim more memory. That's good for large feature_dim.
-        self.avg_reward_matrix = tf.tensordot(
-            self.feature_expectations, self.true_reward_matrix, axes=[-1, -1], name='avg_reward_matrix')
+        self.avg_reward_matrix = self.build_avg_reward_matrix()
 
         log_likelihoods_new = self.beta * self.avg_reward_matrix
 
@@ -149,17 +191,31 @@ class Model(object):
         # Calculate posterior
         # self.prior = tf.compat.v1.placeholder(tf.float32, name="prior", shape=(true_reward_space_size))
         self.log_prior = tf.compat.v1.placeholder(tf.float32, name="log_prior", shape=(true_reward_space_size))
-        log_Z_w = tf.reduce_logsumexp(log_likelihoods_new, axis=0, name='log_Z_w')
-        log_P_q_z = log_likelihoods_new - log_Z_w   # broadcasting
+        # Axes are counted from the end so that batched models can have a leading candidate axis
+        log_Z_w = tf.reduce_logsumexp(log_likelihoods_new, axis=-2, name='log_Z_w')
+        log_P_q_z = log_likelihoods_new - tf.expand_dims(log_Z_w, axis=-2)   # broadcasting
         # self.log_Z_q, max_a, max_b = logdot(log_P_q_z, tf.compat.v1.log(self.prior))
-        self.log_Z_q = tf.reduce_logsumexp(log_P_q_z + self.log_prior, axis=1, name='log_Z_q', keepdims=True)
+        self.log_Z_q = tf.reduce_logsumexp(log_P_q_z + self.log_prior, axis=-1, name='log_Z_q', keepdims=True)
         # TODO: For BALD objective, just take entropy of Z_q - prior expected entropy of q
         # self.log_posterior = log_P_q_z + tf.compat.v1.log(self.prior) - self.log_Z_q
         self.log_posterior = log_P_q_z + self.log_prior - self.log_Z_q  # 2x broadcasting
         self.posterior = tf.exp(self.log_posterior, name="posterior")
 
-        self.post_sum_to_1 = tf.reduce_sum(tf.exp(self.log_posterior), axis=1, name='post_sum_to_1')
+        self.post_sum_to_1 = tf.reduce_sum(tf.exp(self.log_posterior), axis=-1, name='post_sum_to_1')
+
+        self.name_to_op['avg_reward_matrix'] = self.avg_reward_matrix
+        self.name_to_op['true_reward_matrix'] = self.true_reward_matrix
+        # self.name_to_op['prior'] = self.prior
+        self.name_to_op['log_prior'] = self.log_prior
+        self.name_to_op['posterior'] = self.posterior
+        self.name_to_op['log_posterior'] = self.log_posterior
+        self.name_to_op['post_sum_to_1'] = self.post_sum_to_1
 
+    def build_map_to_true_posterior(self):
+        """
+        Samples the answer to the query for self.true_reward and maps it to the posterior, its entropy and mean.
+        """
+        dim = self.feature_dim
 
         # Get log likelihoods for actual true reward
         self.true_reward = tf.compat.v1.placeholder(
@@ -180,9 +236,11 @@ class Model(object):
         self.name_to_op['log_true_answer_probs'] = self.log_true_answer_probs
 
         # # Sample answer
+        # Gumbel-max trick: the noise is drawn by compute from self.answer_random_state, so that answers don't depend
+        # on TF's op-level random state and can be reproduced and checkpointed.
         self.log_true_answer_probs = tf.reshape(self.log_true_answer_probs, shape=[1, -1])
-        sample = tf.compat.v1.multinomial(self.log_true_answer_probs, num_samples=1)
-        sample = sample[0][0]
+        self.answer_noise = tf.compat.v1.placeholder(tf.float32, shape=[None], name="answer_noise")
+        sample = tf.argmax(self.log_true_answer_probs[0] + self.answer_noise, axis=0)
         self.true_log_posterior = self.log_posterior[sample]
         self.true_posterior = self.posterior[sample]
 
@@ -212,15 +270,17 @@ class Model(object):
 
         # Fill name to ops dict
         self.name_to_op['post_avg'] = self.true_post_avg
-        self.name_to_op['avg_reward_matrix'] = self.avg_reward_matrix
-        self.name_to_op['true_reward_matrix'] = self.true_reward_matrix
-        # self.name_to_op['prior'] = self.prior
-        self.name_to_op['log_prior'] = self.log_prior
-        self.name_to_op['posterior'] = self.posterior
-        self.name_to_op['log_posterior'] = self.log_posterior
-        self.name_to_op['post_sum_to_1'] = self.post_sum_to_1
 
 
+    def build_avg_reward_matrix(self):
+        """Returns the expected true reward of each proxy's feature expectations for every true reward.
+        """
+        # Inefficient to recompute this matrix on every forward pass. The matrix multiplication has
+        # size_proxy x size_true x feature_dim complexity. The other calculations in this map have a factor feature_dim
+        # less. CachedNoPlanningModel computes it once per inference and takes proxy indeces instead.
+        return tf.tensordot(
+            self.feature_expectations, self.true_reward_matrix, axes=[-1, -1], name='avg_reward_matrix')
+
     def build_map_to_objective(self, objective):
         """
         :param objective: string that specifies the objective function
@@ -238,11 +298,11 @@ class Model(object):
             scaled_log_posterior = self.log_posterior - 0.0001
             interm_tensor = scaled_log_posterior + tf.compat.v1.log(- scaled_log_posterior)
             self.log_post_ent_new = tf.reduce_logsumexp(
-                interm_tensor, axis=1, name="log_entropy_per_answer", keepdims=True)
+                interm_tensor, axis=-1, name="log_entropy_per_answer", keepdims=True)
             self.post_ent_new = tf.exp(self.log_post_ent_new)
             self.name_to_op['entropy_per_answer'] = self.post_ent_new
             self.log_exp_post_ent = tf.reduce_logsumexp(
-                self.log_post_ent_new + self.log_Z_q, axis=0, keepdims=True, name='log_entropy')
+                self.log_post_ent_new + self.log_Z_q, axis=-2, keepdims=True, name='log_entropy')
             self.exp_post_ent = tf.exp(self.log_exp_post_ent)
             self.name_to_op['entropy'] = self.exp_post_ent
 
@@ -268,17 +328,17 @@ class Model(object):
 
         if 'total_variation' == objective:
 
+            # Posterior weights broadcast over the feature axis of true_reward_matrix
             self.post_averages, self.post_var = tf.nn.weighted_moments(
-                self.true_reward_matrix, [1, 1], tf.stack([self.posterior] * self.feature_dim, axis=2),
+                self.true_reward_matrix, [-2], tf.expand_dims(self.posterior, axis=-1),
                 name="moments", keepdims=False)
             self.name_to_op['post_var'] = self.post_var
 
             self.total_variations = tf.reduce_sum(self.post_var, axis=-1, keepdims=False)
             self.name_to_op['total_variations'] = self.total_variations
-            self.total_variations, self.log_Z_q = tf.reshape(self.total_variations, [-1]), tf.reshape(self.log_Z_q,[-1])
-            self.total_variation = tf.tensordot(
-                self.total_variations, tf.exp(self.log_Z_q), axes=[-1,-1] ,name='total_var')
-            self.total_variation = tf.reshape(self.total_variation, shape=[1,1,-1])
+            self.total_variation = tf.reduce_sum(
+                self.total_variations * tf.exp(tf.squeeze(self.log_Z_q, axis=-1)), axis=-1, name='total_var')
+            self.total_variation = tf.reshape(self.total_variation, shape=[-1,1,1])
             self.name_to_op['total_variation'] = self.total_variation
 
             if self.args.log_objective:
@@ -288,9 +348,9 @@ class Model(object):
 
         # Set up optimizer
         if self.optimize:
-            # optimizer = tf.train.AdamOptimizer(learning_rate=self.lr) # Make sure the momentum is reset for each model call
+            # optimizer = tf.compat.v1.train.AdamOptimizer(learning_rate=self.lr) # Make sure the momentum is reset for each model call
             self.lr_tensor = tf.constant(self.lr)
-            self.optimizer = tf.train.GradientDescentOptimizer(learning_rate=self.lr_tensor)
+            self.optimizer = tf.compat.v1.train.GradientDescentOptimizer(learning_rate=self.lr_tensor)
             self.gradients, self.vs = zip(*self.optimizer.compute_gradients(self.objective))
             # self.gradient_norm = tf.norm(tf.stack(gradients, axis=0))
             self.train_op = self.optimizer.apply_gradients(zip(self.gradients, self.vs))
@@ -301,6 +361,15 @@ class Model(object):
             self.name_to_op['lr_tensor'] = self.lr_tensor
 
 
+    def build_map_to_best_candidate(self, objective):
+        """Finds the candidate with the lowest objective on the device (batched models only).
+        :param objective: string that specifies the objective function
+        """
+        self.objectives = tf.reshape(self.name_to_op[objective], [-1], name='objectives')
+        self.name_to_op['objectives'] = self.objectives
+        self.name_to_op['best_candidate'] = tf.argmin(self.objectives, axis=0, name='best_candidate')
+        self.name_to_op['best_objective'] = tf.reduce_min(self.objectives, name='best_objective')
+
     def compute(self, outputs, sess, mdp, query=None, log_prior=None, weight_inits=None, feature_expectations_input=None,
                 gradient_steps=0, gradient_logging_outputs=[], true_reward=None, true_reward_matrix=None, lr=None):
         """
@@ -329,17 +398,14 @@ class Model(object):
             fd[self.log_prior] = log_prior
 
         if query:
-            if self.discrete and self.optimize:
-                fd[self.known_weights] = query
-            elif self.discrete:
-                fd[self.weights] = query
-            else:
-                fd[self.permutation] = self.get_permutation_from_query(query)
+            self.update_feed_dict_with_query(query, fd)
 
         if true_reward is not None:
             fd[self.true_reward] = true_reward
+        if not self.batched and self.answer_outputs.intersection(outputs):
+            fd[self.answer_noise] = self.answer_random_state.gumbel(size=self.K)
         if true_reward_matrix is not None:
-            fd[self.true_reward_matrix] = true_reward_matrix
+            fd[self.true_reward_matrix_input] = true_reward_matrix
 
         def get_op(name):
             if name not in self.name_to_op:
@@ -362,6 +428,18 @@ class Model(object):
     def update_feed_dict_with_mdp(self, mdp, fd):
         raise NotImplemented('Should be implemented in subclass')
 
+    def update_feed_dict_with_query(self, query, fd):
+        if self.discrete and self.optimize:
+            fd[self.known_weights] = query
+        elif self.discrete:
+            fd[self.weights] = query
+        elif self.batched:
+            # Either one query for all candidates or a list with one query per candidate
+            queries = query if isinstance(query[0], list) else [query] * self.batch_size
+            fd[self.permutation] = [self.get_permutation_from_query(q) for q in queries]
+        else:
+            fd[self.permutation] = self.get_permutation_from_query(query)
+
     def get_permutation_from_query(self, query):
         dim = self.feature_dim
         # Running example: query = [1, 3], and we want indexes that will permute
@@ -389,9 +467,7 @@ class BanditsModel(Model):
         self.name_to_op['features'] = self.features
 
         # Calculate state probabilities
-        weights_expand = tf.expand_dims(self.weights,axis=1)
-        intermediate_tensor = tf.multiply(tf.stack([self.features]*self.K,axis=0), weights_expand)
-        self.reward_per_state = tf.reduce_sum(intermediate_tensor, axis=-1, keepdims=False, name="rewards_per_state")
+        self.reward_per_state = tf.matmul(self.weights, self.features, transpose_b=True, name="rewards_per_state")
         self.name_to_op['reward_per_state'] = self.reward_per_state
         self.name_to_op['q_values'] = self.reward_per_state
 
@@ -406,12 +482,9 @@ class BanditsModel(Model):
 
         self.name_to_op['state_probs'] = self.state_probs
         self.name_to_op['state_probs_cut'] = self.state_probs[:5]
-        """Changes: remove [0] from best state; remove reshape; stack probs on axis 2 (was 1); stack features on axis 1 (was 2); sum features on axis 1 (was 0); remove transpose."""
 
         # Calculate feature expectations
-        probs_stack = tf.stack([self.state_probs] * self.feature_dim, axis=2)
-        features_stack = tf.multiply(tf.stack([self.features] * self.K, axis=0), probs_stack, name='multi')
-        self.feature_expectations = tf.reduce_sum(features_stack, axis=1, keepdims=False, name="feature_exps")
+        self.feature_expectations = tf.matmul(self.state_probs, self.features, name="feature_exps")
         self.name_to_op['feature_exps'] = self.feature_expectations
 
 
@@ -420,9 +493,12 @@ class BanditsModel(Model):
 
 
 class GridworldModel(Model):
+    # Multi-MDP models plan in a batch of gridworlds of the same size at once
+    multi_mdp = False
+
     def __init__(self, feature_dim, gamma, query_size, discretization_const,
                  true_reward_space_size, num_unknown, beta, beta_planner,
-                 objective, lr, discrete, optimize, height, width, num_iters, args):
+                 objective, lr, discrete, optimize, height, width, num_iters, args, batch_size=None):
         self.height = height
         self.width = width
         self.num_iters = num_iters
@@ -430,75 +506,121 @@ class GridworldModel(Model):
         super(GridworldModel, self).__init__(
             feature_dim, gamma, query_size, discretization_const,
             true_reward_space_size, num_unknown, beta, beta_planner,
-            objective, lr, discrete, optimize, args)
+            objective, lr, discrete, optimize, args, batch_size=batch_size)
 
     def build_planner(self):
         height, width, dim = self.height, self.width, self.feature_dim
-        num_actions, K = self.num_actions, self.K
+        # Number of reward functions to plan for (query_size * batch_size for batched models)
+        num_actions, K = self.num_actions, int(self.weights.shape[0])
 
+        # Multi-MDP models have a leading MDP axis on all MDP inputs and planner tensors
+        mdp_shape = [None] if self.multi_mdp else []
         self.image = tf.compat.v1.placeholder(
-            tf.float32, name="image", shape=[height, width])
+            tf.float32, name="image", shape=mdp_shape + [height, width])
         self.features = tf.compat.v1.placeholder(
-            tf.float32, name="features", shape=[height, width, dim])
-        self.start_x = tf.compat.v1.placeholder(tf.int32, name="start_x", shape=[])
-        self.start_y = tf.compat.v1.placeholder(tf.int32, name="start_y", shape=[])
+            tf.float32, name="features", shape=mdp_shape + [height, width, dim])
+        self.start_x = tf.compat.v1.placeholder(tf.int32, name="start_x", shape=mdp_shape)
+        self.start_y = tf.compat.v1.placeholder(tf.int32, name="start_y", shape=mdp_shape)
 
+        # The features are the same for all K reward functions and are broadcast against them.
+        # Shape height by width by dim + 1
         features_wall = tf.concat(
             [self.features, tf.expand_dims(self.image, -1)], axis=-1)
-        features_wall = tf.stack([features_wall] * K, axis=0)
-        wall_constant = [[-1000000.0] for _ in range(K)]
+        wall_constant = tf.constant(-1000000.0, shape=[K, 1])
+        # Shape K by dim + 1
         weights_wall = tf.concat([self.weights, wall_constant], axis=-1)
-        # Change from K by dim to K by 1 by dim
-        weights_wall = tf.expand_dims(weights_wall, axis=1)
-        # Change to K by height by width by 1 by dim
-        weights_wall = tf.stack([weights_wall] * width, axis=1)
-        weights_wall = tf.stack([weights_wall] * height, axis=1)
+        # Shape (num_mdps by) K by height by width
+        rewards_wall = tf.einsum('kd,...hwd->...khw', weights_wall, features_wall)
+        if self.multi_mdp:
+            # Shape num_mdps by 1 by height by width by dim + 1
+            features_wall = tf.expand_dims(features_wall, axis=1)
         dim += 1
 
-        feature_expectations = tf.zeros([K, height, width, dim])
-        for i in range(self.num_iters):
-            q_fes = self.bellman_update(feature_expectations, features_wall)
-            q_values = tf.squeeze(tf.matmul(weights_wall, q_fes), [-2])
+        def value_iteration_step(feature_expectations):
+            # Every action gets the features of the current cell plus the discounted feature expectations of the
+            # cell it leads to, so the Q-values are the rewards plus the discounted values of the neighbouring cells.
+            # This avoids a tensor of feature expectations per action, which is num_actions times as large.
+            q_values = self.get_q_values(feature_expectations, weights_wall, rewards_wall)
             if self.beta_planner == 'inf':
                 best_actions = tf.argmax(q_values, axis=-1)
-                policy = tf.one_hot(best_actions[0], 4)
+                policy = tf.one_hot(best_actions, num_actions)
             else:
                 policy = tf.nn.softmax(self.beta_planner * q_values)
-            repeated_policy = tf.stack([policy] * dim, axis=-2)
-            feature_expectations = tf.reduce_sum(
-                tf.multiply(repeated_policy, q_fes), axis=-1)
-            self.name_to_op['policy'+str(i)] = policy
+            feature_expectations = self.bellman_update(feature_expectations, features_wall, policy)
+            return feature_expectations, policy
+
+        if self.multi_mdp:
+            num_mdps = tf.shape(self.image)[0]
+            feature_expectations = tf.zeros(tf.stack([num_mdps, K, height, width, dim]))
+        else:
+            feature_expectations = tf.zeros([K, height, width, dim])
+        tolerance = self.args.value_iters_tolerance
+        if tolerance:
+            # Iterate until the feature expectations change by less than tolerance, at most num_iters times
+            def not_converged(i, feature_expectations, max_change):
+                return tf.logical_and(i < self.num_iters, max_change >= tolerance)
+
+            def iterate(i, feature_expectations, max_change):
+                new_feature_expectations, _ = value_iteration_step(feature_expectations)
+                return i + 1, new_feature_expectations, tf.reduce_max(
+                    tf.abs(new_feature_expectations - feature_expectations))
+
+            num_value_iters, feature_expectations, _ = tf.compat.v1.while_loop(
+                not_converged, iterate, [tf.constant(0), feature_expectations, tf.constant(np.inf)])
+        else:
+            for i in range(self.num_iters):
+                feature_expectations, policy = value_iteration_step(feature_expectations)
+                self.name_to_op['policy'+str(i)] = policy
+            num_value_iters = tf.constant(self.num_iters)
+        self.name_to_op['num_value_iters'] = num_value_iters
 
 
         # Remove the wall feature
-        self.feature_expectations_grid = feature_expectations[:,:,:,:-1]
+        self.feature_expectations_grid = feature_expectations[...,:-1]
         dim -= 1
         self.name_to_op['feature_exps_grid'] = self.feature_expectations_grid
 
         x, y = self.start_x, self.start_y
-        self.feature_expectations = self.feature_expectations_grid[:,y,x,:]
+        if self.multi_mdp:
+            # Feature expectations at each MDP's own start state. Shape num_mdps by K by dim
+            grid_first = tf.transpose(self.feature_expectations_grid, [0, 2, 3, 1, 4])
+            self.feature_expectations = tf.gather_nd(grid_first, tf.stack([y, x], axis=-1), batch_dims=1)
+        else:
+            self.feature_expectations = self.feature_expectations_grid[:,y,x,:]
         self.name_to_op['feature_exps'] = self.feature_expectations
 
-        q_fes = self.bellman_update(feature_expectations, features_wall)
-        q_values = tf.squeeze(tf.matmul(weights_wall, q_fes), [-2])
+        q_values = self.get_q_values(feature_expectations, weights_wall, rewards_wall)
         self.q_values = q_values
         self.name_to_op['q_values'] = q_values
 
-    def bellman_update(self, fes, features):
-        height, width, dim = self.height, self.width, self.feature_dim + 1
-        gamma, K = self.gamma, self.K
-        extra_row = tf.zeros((K, 1, width, dim))
-        extra_col = tf.zeros((K, height, 1, dim))
-
-        north_lookahead = tf.concat([extra_row, fes[:,:-1]], axis=1)
-        north_fes = features + gamma * north_lookahead
-        south_lookahead = tf.concat([fes[:,1:], extra_row], axis=1)
-        south_fes = features + gamma * south_lookahead
-        east_lookahead = tf.concat([fes[:,:,1:], extra_col], axis=2)
-        east_fes = features + gamma * east_lookahead
-        west_lookahead = tf.concat([extra_col, fes[:,:,:-1]], axis=2)
-        west_fes = features + gamma * west_lookahead
-        return tf.stack([north_fes, south_fes, east_fes, west_fes], axis=-1)
+    def get_lookaheads(self, grid, num_trailing_axes):
+        """Returns the values of grid at the neighbouring cell in each direction (north, south, east, west), zero
+        beyond the edge of the grid. Height and width are the axes before the last num_trailing_axes axes."""
+        trailing = (slice(None),) * num_trailing_axes
+        no_pad = [[0, 0]] * (len(grid.shape) - 2 - num_trailing_axes)
+        trailing_pad = [[0, 0]] * num_trailing_axes
+        north = tf.pad(grid[(Ellipsis, slice(None, -1), slice(None)) + trailing],
+                       no_pad + [[1, 0], [0, 0]] + trailing_pad)
+        south = tf.pad(grid[(Ellipsis, slice(1, None), slice(None)) + trailing],
+                       no_pad + [[0, 1], [0, 0]] + trailing_pad)
+        east = tf.pad(grid[(Ellipsis, slice(1, None)) + trailing], no_pad + [[0, 0], [0, 1]] + trailing_pad)
+        west = tf.pad(grid[(Ellipsis, slice(None, -1)) + trailing], no_pad + [[0, 0], [1, 0]] + trailing_pad)
+        return [north, south, east, west]
+
+    def get_q_values(self, fes, weights, rewards):
+        """Returns the Q-values of the actions (north, south, east, west) with shape (num_mdps by) K by height by
+        width by num_actions, given the feature expectations fes of each cell and the rewards of each cell."""
+        values = tf.einsum('kd,...khwd->...khw', weights, fes)
+        return tf.stack([rewards + self.gamma * lookahead for lookahead in self.get_lookaheads(values, 0)], axis=-1)
+
+    def bellman_update(self, fes, features, policy):
+        """Returns the feature expectations of following policy for one more step. Each action collects the
+        features of the current cell plus the discounted feature expectations of the cell it leads to. features
+        (height by width by dim) broadcasts against the K by height by width by dim feature expectations."""
+        lookaheads = self.get_lookaheads(fes, 1)
+        expected_lookahead = tf.add_n([
+            policy[..., action, None] * lookahead for action, lookahead in enumerate(lookaheads)])
+        return features + self.gamma * expected_lookahead
 
     def update_feed_dict_with_mdp(self, mdp, fd):
         image, features, start_state = mdp.convert_to_numpy_input()
@@ -509,15 +631,77 @@ class GridworldModel(Model):
         fd[self.start_y] = y
 
 
+class MultiMdpGridworldModel(GridworldModel):
+    """Plans for the K query rewards in a batch of gridworlds of the same size in one run. compute() takes a list of
+    MDPs and 'feature_exps' has shape [num_mdps, K, feature_dim]."""
+    batched = True
+    multi_mdp = True
+
+    def update_feed_dict_with_mdp(self, mdps, fd):
+        images, features, start_states = zip(*[mdp.convert_to_numpy_input() for mdp in mdps])
+        fd[self.image] = np.stack(images)
+        fd[self.features] = np.stack(features)
+        fd[self.start_x] = [x for x, y in start_states]
+        fd[self.start_y] = [y for x, y in start_states]
+
+
 class NoPlanningModel(Model):
 
     def build_weights(self):
         pass
 
     def build_planner(self):
+        shape = [None, self.K, self.feature_dim] if self.batched else [self.K, self.feature_dim]
         self.feature_expectations = tf.compat.v1.placeholder(
-            tf.float32, shape=[self.K, self.feature_dim], name='feature_exps')
+            tf.float32, shape=shape, name='feature_exps')
         self.name_to_op['feature_exps'] = self.feature_expectations
 
     def update_feed_dict_with_mdp(self, mdp, fd):
         pass
+
+
+class CachedNoPlanningModel(NoPlanningModel):
+    """Same as NoPlanningModel, but reads the proxy by true reward matrix from a cache instead of computing it.
+
+    The cache holds feature_exp_matrix @ true_reward_matrix.T for the whole proxy space (restricted to the current
+    true reward subsample). It is a single graph variable shared by all CachedNoPlanningModels, so it only needs to be
+    loaded once per inference and subsample. Queries are fed as indeces into the proxy space.
+    """
+
+    def build_planner(self):
+        super(CachedNoPlanningModel, self).build_planner()
+        shape = [None, self.K] if self.batched else [self.K]
+        self.query_idx = tf.compat.v1.placeholder(
+            tf.int32, shape=shape, name='query_idx')
+        with tf.compat.v1.variable_scope('likelihood_cache', reuse=tf.compat.v1.AUTO_REUSE):
+            # Not in any collection so that initialize_op of other models doesn't reset it
+            self.avg_reward_cache = tf.compat.v1.get_variable(
+                'avg_reward_cache', initializer=tf.zeros([0, 0]), validate_shape=False,
+                trainable=False, collections=[])
+        self.avg_reward_cache_input = tf.compat.v1.placeholder(
+            tf.float32, shape=[None, None], name='avg_reward_cache_input')
+        self.load_cache_op = tf.compat.v1.assign(
+            self.avg_reward_cache, self.avg_reward_cache_input, validate_shape=False)
+
+    def build_avg_reward_matrix(self):
+        avg_reward_matrix = tf.gather(self.avg_reward_cache, self.query_idx, name='avg_reward_matrix')
+        avg_reward_matrix.set_shape(self.query_idx.shape.concatenate([None]))
+        return avg_reward_matrix
+
+    def load_likelihood_cache(self, sess, avg_reward_matrix):
+        """Loads a [size_proxy, size_true] matrix of expected true rewards into the shared cache."""
+        sess.run(self.load_cache_op, feed_dict={self.avg_reward_cache_input: avg_reward_matrix})
+
+    def update_feed_dict_with_query(self, query, fd):
+        fd[self.query_idx] = query
+
+
+class BatchedNoPlanningModel(NoPlanningModel):
+    """Evaluates a batch of candidate queries in one run. feature_exps has shape
+    [num_candidates, query_size, feature_dim] and 'best_candidate' is the argmin of the objective."""
+    batched = True
+
+
+class BatchedCachedNoPlanningModel(CachedNoPlanningModel):
+    """Batched version of CachedNoPlanningModel. query_idx has shape [num_candidates, query_size]."""
+    batched = True
@@ -0,0 +1,128 @@
+import argparse
+import numpy as np
+import tensorflow as tf
+import unittest
+
+from env_bank import generate_gridworld, generate_bandits
+from planner import GridworldModel, MultiMdpGridworldModel, BanditsModel
+
+
+def make_args(**kwargs):
+    args = argparse.Namespace(
+        seed=1, log_objective=1, compact_dtypes=0, value_iters_tolerance=0, mdp_type='gridworld', height=7, width=7,
+        feature_dim=4, dist_scale=0.2, linear_features=1, repeated_obj=0, num_obj_if_repeated=6)
+    args.__dict__.update(kwargs)
+    return args
+
+
+def plan_in_gridworld(weights, mdp, gamma, beta_planner, num_iters, tolerance=0.):
+    """NumPy value iteration for the feature expectations of each row of weights from the start state of mdp.
+    Stops early once they change by less than tolerance. Returns them and the number of iterations."""
+    image, features, (x, y) = mdp.convert_to_numpy_input()
+    features_wall = np.concatenate([features, image[..., None]], axis=-1)
+    weights_wall = np.concatenate([weights, np.full([len(weights), 1], -1000000.)], axis=-1)
+    feature_exps = np.zeros((len(weights),) + features_wall.shape)
+    for i in range(num_iters):
+        # Lookaheads in the order north, south, east, west, zero beyond the edge of the grid
+        lookaheads = [np.zeros_like(feature_exps) for _ in range(4)]
+        lookaheads[0][:, 1:] = feature_exps[:, :-1]
+        lookaheads[1][:, :-1] = feature_exps[:, 1:]
+        lookaheads[2][:, :, :-1] = feature_exps[:, :, 1:]
+        lookaheads[3][:, :, 1:] = feature_exps[:, :, :-1]
+        q_fes = np.stack([features_wall + gamma * lookahead for lookahead in lookaheads], axis=-1)
+        q_values = np.einsum('kd,khwda->khwa', weights_wall, q_fes)
+        if beta_planner == 'inf':
+            policy = np.eye(4)[np.argmax(q_values, axis=-1)]
+        else:
+            policy = np.exp(beta_planner * (q_values - q_values.max(axis=-1, keepdims=True)))
+            policy /= policy.sum(axis=-1, keepdims=True)
+        new_feature_exps = np.einsum('khwa,khwda->khwd', policy, q_fes)
+        max_change = np.abs(new_feature_exps - feature_exps).max()
+        feature_exps = new_feature_exps
+        if tolerance and max_change < tolerance:
+            return feature_exps[:, y, x, :-1], i + 1
+    return feature_exps[:, y, x, :-1], num_iters
+
+
+class TestGridworldModel(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(1)
+        self.args = make_args()
+        self.mdp = generate_gridworld(self.args, 1)
+        self.weights = np.random.randn(3, self.args.feature_dim)
+
+    def compute(self, outputs, gamma, beta_planner, num_iters, weights=None, **kwargs):
+        weights = self.weights if weights is None else weights
+        tf.compat.v1.reset_default_graph()
+        model = GridworldModel(
+            self.args.feature_dim, gamma, len(weights), 5, None, None, 0.5, beta_planner, 'entropy', 0.1, True,
+            False, self.args.height, self.args.width, num_iters, make_args(**kwargs))
+        with tf.compat.v1.Session() as sess:
+            model.initialize(sess)
+            return model.compute(outputs, sess, self.mdp, list(weights))
+
+    def test_feature_exps(self):
+        # The rational planner follows each proxy's own greedy policy
+        for beta_planner in [0.5, 'inf']:
+            feature_exps, = self.compute(['feature_exps'], 1., beta_planner, 15)
+            expected, _ = plan_in_gridworld(self.weights, self.mdp, 1., beta_planner, 15)
+            np.testing.assert_allclose(feature_exps, expected, rtol=1e-4, atol=1e-4, err_msg=str(beta_planner))
+
+    def test_multi_mdp(self):
+        mdps = [self.mdp] + [generate_gridworld(self.args, env_seed) for env_seed in [2, 3]]
+        for beta_planner in [0.5, 'inf']:
+            tf.compat.v1.reset_default_graph()
+            model = MultiMdpGridworldModel(
+                self.args.feature_dim, 1., 1, 5, None, None, 0.5, beta_planner, 'entropy', 0.1, True, False,
+                self.args.height, self.args.width, 15, self.args)
+            with tf.compat.v1.Session() as sess:
+                model.initialize(sess)
+                feature_exps, = model.compute(['feature_exps'], sess, mdps, [list(self.weights[0])])
+            self.assertEqual(feature_exps.shape, (len(mdps), 1, self.args.feature_dim))
+            for mdp, mdp_feature_exps in zip(mdps, feature_exps):
+                expected, _ = plan_in_gridworld(self.weights[:1], mdp, 1., beta_planner, 15)
+                np.testing.assert_allclose(mdp_feature_exps, expected, rtol=1e-4, atol=1e-4, err_msg=str(beta_planner))
+
+    def test_value_iters_tolerance(self):
+        gamma, beta_planner, num_iters, tolerance = 0.9, 0.5, 300, 1e-4
+        feature_exps, num_value_iters = self.compute(
+            ['feature_exps', 'num_value_iters'], gamma, beta_planner, num_iters, value_iters_tolerance=tolerance)
+        expected, expected_iters = plan_in_gridworld(
+            self.weights, self.mdp, gamma, beta_planner, num_iters, tolerance)
+        self.assertLess(num_value_iters, num_iters)
+        # TF plans in float32, where the wall weight leaves the Q-values of wall cells a resolution of about 0.06. That
+        # can move the last change across the tolerance a couple of iterations earlier or later.
+        self.assertAlmostEqual(num_value_iters, expected_iters, delta=2)
+        np.testing.assert_allclose(feature_exps, expected, rtol=1e-4, atol=1e-3)
+
+        # Close to the feature expectations of all num_iters iterations
+        converged, _ = plan_in_gridworld(self.weights, self.mdp, gamma, beta_planner, num_iters)
+        np.testing.assert_allclose(feature_exps, converged, atol=tolerance / (1 - gamma))
+
+
+class TestBanditsModel(unittest.TestCase):
+    def test_feature_exps(self):
+        np.random.seed(1)
+        args = make_args(mdp_type='bandits', num_states=20)
+        mdp = generate_bandits(args, 1)
+        weights = np.random.randn(3, args.feature_dim)
+        features = mdp.convert_to_numpy_input()
+        for beta_planner in [0.5, 'inf']:
+            tf.compat.v1.reset_default_graph()
+            model = BanditsModel(args.feature_dim, 1., len(weights), 5, None, None, 0.5, beta_planner, 'entropy', 0.1,
+                                 True, False, args)
+            with tf.compat.v1.Session() as sess:
+                model.initialize(sess)
+                feature_exps, = model.compute(['feature_exps'], sess, mdp, list(weights))
+
+            rewards = np.dot(weights, features.T)
+            if beta_planner == 'inf':
+                state_probs = np.eye(len(features))[np.argmax(rewards, axis=-1)]
+            else:
+                state_probs = np.exp(beta_planner * (rewards - rewards.max(axis=-1, keepdims=True)))
+                state_probs /= state_probs.sum(axis=-1, keepdims=True)
+            np.testing.assert_allclose(feature_exps, np.dot(state_probs, features), rtol=1e-4, atol=1e-4)
+
+
+if __name__ == '__main__':
+    unittest.main()
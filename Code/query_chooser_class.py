@@ -1,14 +1,23 @@
 from itertools import combinations, product
 from scipy.special import comb
-from random import choice, sample, seed
+from random import choice, sample, seed, getstate, setstate
 import numpy as np
+import heapq
 import time
 from gridworld import NStateMdp, GridworldEnvironment, NStateMdpHardcodedFeatures, NStateMdpGaussianFeatures,\
     NStateMdpRandomGaussianFeatures, GridworldMdpWithDistanceFeatures, GridworldMdp
 import csv
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import os
+import pickle
 import datetime
-from planner import GridworldModel, BanditsModel, NoPlanningModel
+from planner import GridworldModel, MultiMdpGridworldModel, BanditsModel, NoPlanningModel, CachedNoPlanningModel, BatchedNoPlanningModel,\
+    BatchedCachedNoPlanningModel
+from numpy_model import NumpyNoPlanningModel, IncrementalQueryEvaluator, QueryBranchAndBound
+from utils import write_atomically
 import tensorflow as tf
 from itertools import product
 
@@ -20,24 +29,47 @@ def random_combination(iterable, r):
     indices = sorted(sample(range(n), r))
     return tuple(pool[i] for i in indices)
 
+def get_params_name(exp_params):
+    """Returns the part of an experiment's folder name that comes after its start time."""
+    return '-'.join([key+'='+str(val) for key, val in sorted(exp_params.items())])
+
 def time_function(function, input):
     "Calls function and returns time it took"
-    start = time.clock()
+    start = time.perf_counter()
     function(input)
-    deltat = time.clock() - start
+    deltat = time.perf_counter() - start
     return deltat
 
 
 class Query_Chooser(object):
+    # Rewards that agree to this many decimals share an entry of the planning cache
+    planning_cache_decimals = 6
+
     def __init__(self, num_queries_max, args, cost_of_asking=0, t_0 = None):
         self.cost_of_asking = cost_of_asking
         self.num_queries_max = num_queries_max
         self.args = args    # all args
         self.t_0 = t_0
         self.model_cache = {}
+        self.likelihood_cache_key = None
+        self.lazy_gains_heap = None
+        # True reward space (matrix, log prior, indeces) shared by the extensions of a query, see build_discrete_query
+        self.query_true_reward_space = None
+        # LRU cache of single-reward planning results with its statistics
+        self.planning_cache = OrderedDict()
+        self.planning_cache_hits, self.planning_cache_misses = 0, 0
+        # Answers to queries are sampled from this random state. Experiment.run_experiment seeds it per experiment, so
+        # that the answers don't depend on how many models were built or which other random draws were made.
+        self.answer_random_state = np.random.RandomState(args.seed)
+        # Weights of cached models restored from a checkpoint, assigned when get_model builds the model
+        self.restored_model_weights = {}
 
         config = tf.compat.v1.ConfigProto()
         config.gpu_options.allow_growth = True
+        if args.num_workers > 1:
+            # Share the cores between the sessions of the worker processes
+            config.intra_op_parallelism_threads = max(1, multiprocessing.cpu_count() // args.num_workers)
+            config.inter_op_parallelism_threads = 1
         self.sess = tf.compat.v1.Session(config=config)
 
     def cache_feature_expectations(self, reward_space=None):
@@ -48,22 +80,107 @@ class Query_Chooser(object):
             reward_space = self.inference.reward_space_proxy
 
         proxy_list = [list(reward) for reward in reward_space]
-        print('building graph. Total experiment time: {t}'.format(t=time.clock()-self.t_0))
-        # TODO: This will build a separate model for every reward space size after eliminating duplicates
-        model = self.get_model(len(proxy_list), 'entropy', cache=(not use_proxy_space))
-        model.initialize(self.sess)
-
-        desired_outputs = ['feature_exps']
         mdp = self.inference.mdp
-        print('Computing model outputs. Total experiment time: {t}'.format(t=time.clock()-self.t_0))
-        [feature_exp_matrix] = model.compute(
-            desired_outputs, self.sess, mdp, proxy_list)
-        print('Done computing model outputs. Total experiment time: {t}'.format(t=time.clock()-self.t_0))
+        cache_path = None
+        if self.args.feature_exps_cache_dir:
+            cache_path = os.path.join(self.args.feature_exps_cache_dir,
+                                      self.get_feature_exps_key(mdp, proxy_list) + '.npy')
+        if cache_path is not None and os.path.exists(cache_path):
+            feature_exp_matrix = np.load(cache_path)
+            print('Loaded feature expectations from {path}'.format(path=cache_path))
+        else:
+            print('building graph. Total experiment time: {t}'.format(t=time.perf_counter()-self.t_0))
+            chunk_size = self.args.proxy_chunk_size
+            if chunk_size and chunk_size < len(proxy_list):
+                # Plan for chunk_size proxies per run of one cached model, so that memory doesn't grow with the space.
+                # With args.value_iters_tolerance, each chunk iterates until its own proxies converge.
+                model = self.get_model(chunk_size, 'entropy')
+            else:
+                # TODO: This will build a separate model for every reward space size after eliminating duplicates
+                chunk_size = len(proxy_list)
+                model = self.get_model(chunk_size, 'entropy', cache=(not use_proxy_space))
+            model.initialize(self.sess)
+
+            desired_outputs = ['feature_exps']
+            if mdp.type == 'gridworld':
+                desired_outputs.append('num_value_iters')
+            print('Computing model outputs. Total experiment time: {t}'.format(t=time.perf_counter()-self.t_0))
+            chunks, num_value_iters = [], []
+            for start in range(0, len(proxy_list), chunk_size):
+                chunk = proxy_list[start:start + chunk_size]
+                num_proxies = len(chunk)
+                # Fill up the last chunk by repeating its last proxy
+                chunk = chunk + chunk[-1:] * (chunk_size - num_proxies)
+                outputs = model.compute(desired_outputs, self.sess, mdp, chunk)
+                chunks.append(outputs[0][:num_proxies])
+                num_value_iters.extend(outputs[1:])
+            feature_exp_matrix = np.concatenate(chunks)
+            print('Done computing model outputs. Total experiment time: {t}'.format(t=time.perf_counter()-self.t_0))
+            if mdp.type == 'gridworld':
+                print('Value iterations used: {n}'.format(n=max(num_value_iters)))
+            if cache_path is not None:
+                write_atomically(cache_path, lambda f: np.save(f, feature_exp_matrix))
 
         if use_proxy_space:
             self.inference.feature_exp_matrix = feature_exp_matrix
+            if self.args.cache_likelihoods:
+                # Expected true reward of each proxy, for every true reward. Computed once per inference.
+                self.inference.avg_reward_matrix = np.dot(
+                    feature_exp_matrix, self.inference.reward_space_true.T).astype(np.float32)
+                self.likelihood_cache_key = None
         return feature_exp_matrix
 
+    def plan_for_reward(self, reward, mdp, rational_planner=False):
+        """Returns the feature expectations of planning for a single reward in mdp. If args.planning_cache_size is set,
+        results are kept in an LRU cache of that size keyed by the MDP, the reward rounded to
+        planning_cache_decimals and the planner settings."""
+        planning_model = self.get_model(1, 'entropy', rational_planner=rational_planner)
+        if not self.args.planning_cache_size:
+            return planning_model.compute(['feature_exps'], self.sess, mdp, [list(reward)])[0]
+
+        args = self.args
+        key = (id(mdp), tuple(np.round(reward, self.planning_cache_decimals)), rational_planner, args.gamma,
+               args.beta_planner, args.value_iters, args.value_iters_tolerance)
+        if key in self.planning_cache:
+            self.planning_cache_hits += 1
+            self.planning_cache.move_to_end(key)
+            return self.planning_cache[key]
+        self.planning_cache_misses += 1
+        feature_exps = planning_model.compute(['feature_exps'], self.sess, mdp, [list(reward)])[0]
+        self.planning_cache[key] = feature_exps
+        if len(self.planning_cache) > args.planning_cache_size:
+            self.planning_cache.popitem(last=False)
+        return feature_exps
+
+    def get_feature_exps_key(self, mdp, proxy_list):
+        """Returns a hash of everything the feature expectations of the proxies in mdp depend on."""
+        mdp_input = mdp.convert_to_numpy_input()
+        if not isinstance(mdp_input, tuple):
+            mdp_input = (mdp_input,)
+        digest = hashlib.sha1()
+        for array in mdp_input + (np.asarray(proxy_list, dtype=np.float64),):
+            array = np.ascontiguousarray(array)
+            digest.update(repr((array.dtype.str, array.shape)).encode())
+            digest.update(array.tobytes())
+        args = self.args
+        digest.update(repr((mdp.type, args.gamma, args.beta_planner, args.value_iters,
+                            args.value_iters_tolerance)).encode())
+        return digest.hexdigest()
+
+    def load_likelihood_cache(self, model, true_reward_idx=None):
+        """Loads the columns of inference.avg_reward_matrix for the given true reward indeces (or all columns if
+        true_reward_idx is None) into the cache shared by all CachedNoPlanningModels."""
+        if true_reward_idx is None:
+            # CachedNoPlanningModels share one cache variable, other models hold their own cache
+            key = (id(self.inference), self.inference.support_version,
+                   None if isinstance(model, CachedNoPlanningModel) else id(model))
+            if key == self.likelihood_cache_key:
+                return
+        else:
+            key = None
+        model.load_likelihood_cache(self.sess, self.inference.get_avg_reward_matrix(true_reward_idx))
+        self.likelihood_cache_key = key
+
     # @profile
     def find_query(self, query_size, chooser, true_reward):
         """Calls query chooser specified by chooser (string)."""
@@ -153,6 +270,8 @@ class Query_Chooser(object):
         elif random_query:
             best_query = [choice(self.inference.reward_space_proxy) for _ in range(query_size)]
         # Find best query by greedy or exhaustive search
+        elif exhaustive_query and self.args.branch_and_bound and measure == 'entropy':
+            best_query = self.find_query_branch_and_bound(query_size, measure)
         elif exhaustive_query:
             best_query = self.build_discrete_query(
                 query_size, measure, growth_rate, self.extend_with_discretization, exhaustive_query=True)
@@ -160,7 +279,7 @@ class Query_Chooser(object):
             best_query = self.build_discrete_query(
                 query_size, measure, growth_rate, self.extend_with_discretization, exhaustive_query=False)
 
-        time_last_query_found = time.clock()
+        time_last_query_found = time.perf_counter()
 
         desired_outputs = [measure, 'true_log_posterior', 'true_entropy', 'post_avg']
         # Set model inputs if they're not set
@@ -177,6 +296,22 @@ class Query_Chooser(object):
         print('Best objective found with a discrete query: ' + str(best_objective[0][0]))
         return None, best_objective[0][0], true_log_posterior, true_entropy[0], post_avg, time_last_query_found
 
+    def find_query_branch_and_bound(self, query_size, measure):
+        """Searches all combinations of query_size proxies with QueryBranchAndBound, starting from the greedy query,
+        within the budget args.bnb_max_nodes / args.bnb_max_seconds. Prints the optimality gap."""
+        greedy_query = self.build_discrete_query(query_size, measure, 1, self.extend_with_discretization)
+        greedy_idx = [self.inference.reward_index_proxy[tuple(reward)] for reward in greedy_query]
+
+        true_reward_matrix, log_prior, true_reward_idx = self.get_true_reward_space(return_idx=True)
+        avg_reward_matrix = self.get_avg_reward_matrix(true_reward_matrix, true_reward_idx)
+        search = QueryBranchAndBound(
+            self.args.beta, avg_reward_matrix, log_prior, query_size,
+            max_nodes=self.args.bnb_max_nodes, max_seconds=self.args.bnb_max_seconds)
+        best_idx, best_objective, lower_bound, num_nodes = search.search(incumbent=greedy_idx)
+        print('Branch and bound: objective {o} after {n} nodes, optimality gap {g}'.format(
+            o=best_objective, n=num_nodes, g=best_objective - lower_bound))
+        return [self.inference.reward_space_proxy[i] for i in best_idx]
+
     def build_discrete_query(self, query_size, measure, growth_rate, extend_fn, exhaustive_query=False):
         """Builds a discrete query by starting from the empty query and calling
         extend_fn to add growth_rate rewards to it until it reaches query_size
@@ -187,6 +322,11 @@ class Query_Chooser(object):
         it is guaranteed that the returned query is of size query_size.
         """
         best_query = []
+        self.lazy_gains_heap = None
+        # Lazy greedy's stale gains only bound gains of the same objective, so the true reward subsample is drawn once
+        # for the whole query rather than for every extension
+        if self.args.lazy_greedy and growth_rate == 1 and extend_fn == self.extend_with_discretization:
+            self.query_true_reward_space = self.get_true_reward_space(return_idx=True)
         while len(best_query) < query_size:
             size_increase = min(growth_rate, query_size - len(best_query))
             # Discrete queries of size 1 make no sense, so increase to size 2
@@ -195,6 +335,7 @@ class Query_Chooser(object):
             # if growth_rate > 1:
             #     exhaustive = True
             best_query, _ = extend_fn(best_query, size_increase, measure, exhaustive_query)
+        self.query_true_reward_space = None
         return best_query
 
     def extend_with_discretization(self, curr_query, num_to_add, measure, exhaustive_query):
@@ -210,31 +351,177 @@ class Query_Chooser(object):
             query_extensions = self.generate_set_of_queries(num_to_add)
         else: raise ValueError('Must add >0 proxies to query (may have selected growth rate >2 for greedy).')
 
-        true_reward_matrix, log_prior = self.get_true_reward_space()
-        model = self.get_model(len(curr_query) + num_to_add, measure, no_planning=True)
+        if self.query_true_reward_space is not None:
+            true_reward_matrix, log_prior, true_reward_idx = self.query_true_reward_space
+        else:
+            true_reward_matrix, log_prior, true_reward_idx = self.get_true_reward_space(return_idx=True)
+        if num_to_add == 1 and (self.args.lazy_greedy or self.use_incremental_evaluator(measure)):
+            if self.args.lazy_greedy:
+                best_proxy, best_objective = self.find_best_proxy_lazily(
+                    curr_query, measure, true_reward_matrix, log_prior, true_reward_idx)
+            else:
+                score_extensions = self.get_extension_scorer(
+                    curr_query, measure, true_reward_matrix, log_prior, true_reward_idx)
+                objectives = score_extensions(np.arange(len(self.inference.reward_space_proxy)))
+                best_proxy = np.argmin(objectives)
+                best_objective = objectives[best_proxy]
+            best_query = curr_query + [self.inference.reward_space_proxy[best_proxy]]
+            print('Objective for size {s}: '.format(s=len(best_query)) + str(best_objective))
+            return best_query, best_objective
+        if self.args.query_batch_size:
+            queries = [curr_query + query for query in query_extensions]
+            best_query, best_objective = self.find_best_query_batched(
+                queries, measure, true_reward_matrix, log_prior, true_reward_idx)
+            print('Objective for size {s}: '.format(s=len(best_query)) + str(best_objective))
+            return best_query, best_objective
+
+        cache_likelihoods = self.args.cache_likelihoods
+        model = self.get_model(
+            len(curr_query) + num_to_add, measure, no_planning=True, cache_likelihoods=cache_likelihoods)
+        if cache_likelihoods:
+            self.load_likelihood_cache(model, true_reward_idx)
+            if measure != 'total_variation':    # Only objective that still needs the matrix itself
+                true_reward_matrix = None
         for query in query_extensions:
             query = curr_query + query  # query must be LIST of one or more arrays
             idx = [self.inference.reward_index_proxy[tuple(reward)] for reward in query]
-            feature_exp_input = self.inference.feature_exp_matrix[idx, :]
+            objective = self.compute_discrete_objective(model, idx, measure, log_prior, true_reward_matrix)
+            if objective < best_objective:
+                best_objective = objective
+                best_query = query
+        print('Objective for size {s}: '.format(s=len(best_query)) + str(best_objective))
+        return best_query, best_objective
 
-            # Compute objective
+    def compute_discrete_objective(self, model, idx, measure, log_prior, true_reward_matrix):
+        """Returns the objective of the query with proxy indeces idx. The model must come from get_model with
+        no_planning=True and the current cache_likelihoods setting (and its likelihood cache must be loaded)."""
+        if self.args.cache_likelihoods:
+            objective = model.compute(
+                [measure], self.sess, None, idx, log_prior,
+                true_reward_matrix=true_reward_matrix)
+        else:
+            feature_exp_input = self.inference.feature_exp_matrix[idx, :]
             objective = model.compute(
                 [measure], self.sess, None, None, log_prior,
                 feature_expectations_input=feature_exp_input,
                 true_reward_matrix=true_reward_matrix)
+        return objective[0][0][0]
+
+    def use_incremental_evaluator(self, measure):
+        return self.args.incremental_greedy and measure in ['entropy', 'query_neg_entropy']
 
-            if objective[0][0][0] < best_objective:
+    def get_extension_scorer(self, curr_query, measure, true_reward_matrix, log_prior, true_reward_idx=None):
+        """Returns a function that maps an array of proxy indeces to the objectives of curr_query + [proxy].
+        Uses an IncrementalQueryEvaluator if args.incremental_greedy is set and supports the objective."""
+        curr_idx = [self.inference.reward_index_proxy[tuple(reward)] for reward in curr_query]
+        if self.use_incremental_evaluator(measure):
+            avg_reward_matrix = self.get_avg_reward_matrix(true_reward_matrix, true_reward_idx)
+            evaluator = IncrementalQueryEvaluator(self.args.beta, avg_reward_matrix[curr_idx], log_prior)
+            return lambda proxies: evaluator.evaluate(avg_reward_matrix[proxies], measure)
+
+        cache_likelihoods = self.args.cache_likelihoods
+        model = self.get_model(
+            len(curr_query) + 1, measure, no_planning=True, cache_likelihoods=cache_likelihoods)
+        if cache_likelihoods:
+            self.load_likelihood_cache(model, true_reward_idx)
+            if measure != 'total_variation':
+                true_reward_matrix = None
+        return lambda proxies: np.array([
+            self.compute_discrete_objective(model, curr_idx + [proxy], measure, log_prior, true_reward_matrix)
+            for proxy in proxies])
+
+    def find_best_proxy_lazily(self, curr_query, measure, true_reward_matrix, log_prior, true_reward_idx=None):
+        """Lazy greedy: returns the index of the proxy whose addition to curr_query reduces the objective most, and
+        the resulting objective.
+
+        Keeps the reductions (gains) of all proxies from earlier rounds in a max-heap. If the objective is
+        submodular, gains only shrink as the query grows, so a stale gain is an upper bound and the first proxy that
+        stays on top after being re-evaluated is the greedy choice. If a re-evaluated gain exceeds its stale bound,
+        the bounds can't be trusted and all proxies are rescored.
+        """
+        num_proxies = len(self.inference.reward_space_proxy)
+        curr_idx = [self.inference.reward_index_proxy[tuple(reward)] for reward in curr_query]
+        cache_likelihoods = self.args.cache_likelihoods
+        curr_model = self.get_model(len(curr_query), measure, no_planning=True, cache_likelihoods=cache_likelihoods)
+        if cache_likelihoods:
+            self.load_likelihood_cache(curr_model, true_reward_idx)
+        curr_objective = self.compute_discrete_objective(
+            curr_model, curr_idx, measure, log_prior,
+            None if cache_likelihoods and measure != 'total_variation' else true_reward_matrix)
+        score_extensions = self.get_extension_scorer(
+            curr_query, measure, true_reward_matrix, log_prior, true_reward_idx)
+        # Tolerance for numerical noise when checking that gains don't increase
+        tolerance = 1e-5 * max(1., abs(curr_objective))
+
+        num_evaluated = 0
+        if self.lazy_gains_heap is None:
+            num_evaluated, heap = num_proxies, None
+        else:
+            heap = self.lazy_gains_heap
+            is_fresh = np.zeros(num_proxies, dtype=bool)
+            while not is_fresh[heap[0][1]]:
+                stale_gain, proxy = -heap[0][0], heap[0][1]
+                gain = curr_objective - score_extensions([proxy])[0]
+                num_evaluated += 1
+                if gain > stale_gain + tolerance:
+                    print('Gain of proxy {p} increased; rescoring all proxies'.format(p=proxy))
+                    num_evaluated, heap = num_evaluated + num_proxies, None
+                    break
+                heapq.heapreplace(heap, (-gain, proxy))
+                is_fresh[proxy] = True
+        if heap is None:
+            gains = curr_objective - score_extensions(np.arange(num_proxies))
+            heap = [(-gain, proxy) for proxy, gain in enumerate(gains)]
+            heapq.heapify(heap)
+        self.lazy_gains_heap = heap
+
+        print('Lazy greedy evaluated {n} of {N} proxies'.format(n=num_evaluated, N=num_proxies))
+        best_gain, best_proxy = -heap[0][0], heap[0][1]
+        return best_proxy, curr_objective - best_gain
+
+    def get_avg_reward_matrix(self, true_reward_matrix, true_reward_idx=None):
+        """Returns the [size_proxy, size_true] expected true rewards of all proxies. Uses the likelihood cache if there
+        is one, in which case true_reward_idx selects its columns."""
+        if self.args.cache_likelihoods:
+            return self.inference.get_avg_reward_matrix(true_reward_idx)
+        return np.dot(self.inference.feature_exp_matrix, np.asarray(true_reward_matrix, dtype=np.float32).T)
+
+    def find_best_query_batched(self, queries, measure, true_reward_matrix, log_prior, true_reward_idx=None):
+        """Evaluates the objective of all queries (lists of proxies of the same size) with a batched model in
+        batches of args.query_batch_size queries. Returns the query with the lowest objective and its objective."""
+        cache_likelihoods = self.args.cache_likelihoods
+        model = self.get_model(
+            len(queries[0]), measure, no_planning=True, cache_likelihoods=cache_likelihoods, batched=True)
+        if cache_likelihoods:
+            self.load_likelihood_cache(model, true_reward_idx)
+            if measure != 'total_variation':
+                true_reward_matrix = None
+        idx = np.array([[self.inference.reward_index_proxy[tuple(reward)] for reward in query] for query in queries])
+
+        best_objective, best_query = float("inf"), None
+        batch_size = self.args.query_batch_size
+        for start in range(0, len(queries), batch_size):
+            batch_idx = idx[start:start + batch_size]
+            if cache_likelihoods:
+                best_candidate, objective = model.compute(
+                    ['best_candidate', 'best_objective'], self.sess, None, batch_idx.tolist(), log_prior,
+                    true_reward_matrix=true_reward_matrix)
+            else:
+                best_candidate, objective = model.compute(
+                    ['best_candidate', 'best_objective'], self.sess, None, None, log_prior,
+                    feature_expectations_input=self.inference.feature_exp_matrix[batch_idx],
+                    true_reward_matrix=true_reward_matrix)
+            if objective < best_objective:
                 best_objective = objective
-                best_query = query
-        print('Objective for size {s}: '.format(s=len(best_query)) + str(best_objective[0][0][0]))
-        return best_query, best_objective[0][0][0]
+                best_query = queries[start + best_candidate]
+        return best_query, best_objective
 
     def find_discrete_query_with_optimization(
             self, query_size, measure, true_reward, growth_rate=None):
         best_query = self.build_discrete_query(
             query_size, measure, growth_rate, self.extend_with_optimization)
 
-        time_last_query_found = time.clock
+        time_last_query_found = time.perf_counter()
 
         desired_outputs = [measure, 'true_log_posterior', 'true_entropy', 'post_avg']
         true_reward_matrix, log_prior = self.get_true_reward_space(no_subsampling=True)
@@ -267,6 +554,18 @@ class Query_Chooser(object):
         return query, objective[0][0]
 
     def find_next_feature(self, curr_query, curr_weights, measure, max_query_size):
+        if self.args.batch_features:
+            queries, objectives, optimal_weights, feature_exps = self.find_next_feature_batched(
+                curr_query, curr_weights, measure, max_query_size)
+            best_objective_plus_cost = float("inf")
+            for i, query in enumerate(queries):
+                objective_plus_cost = objectives[i] + self.cost_of_asking * len(query)
+                if objective_plus_cost <= best_objective_plus_cost + 1e-14:
+                    best_objective_plus_cost = objective_plus_cost
+                    best = i
+            print('Objective for size {s}: '.format(s=len(queries[best])) + str(objectives[best][0][0]))
+            return queries[best], optimal_weights[best], feature_exps[best]
+
         mdp = self.inference.mdp
         desired_outputs = [measure, 'weights_to_train', 'feature_exps']
         features = [i for i in range(self.args.feature_dim) if i not in curr_query]
@@ -283,31 +582,12 @@ class Query_Chooser(object):
             # Resampling weights for each feature
             model.initialize(self.sess)
             query = curr_query+[feature]
-            weights = None
+            gd_steps, num_search = self.get_optimization_steps(len(query), max_query_size)
             if not self.search:
 
                 # Set weight inits
                 num_fixed = self.args.feature_dim - len(query)
-                if not self.init_none:
-                    if curr_weights is not None:
-                        weights = list(curr_weights[:i]) + list(curr_weights[i+1:])
-                elif self.zeros:
-                    weights = list(np.zeros(num_fixed))
-                # Initialize with random weights
-                else:
-                    weights = self.sample_weights('init', num_fixed)
-
-                # Set gradient steps
-                gd_steps_if_optim = self.args.num_iters_optim
-                if self.no_optimize:
-                    gd_steps = 0
-                elif self.args.only_optim_biggest:
-                    if len(query) < max_query_size:
-                        gd_steps = 0
-                    else:
-                        gd_steps = gd_steps_if_optim
-                else:
-                    gd_steps = gd_steps_if_optim
+                weights = self.get_weight_inits(curr_weights, i, num_fixed)
 
                 # Calculate (optimized) objective
                 # objective_before_optim = model.compute(
@@ -324,21 +604,6 @@ class Query_Chooser(object):
                 objective_plus_cost = objective + query_cost
             # Find weights by search over samples
             else:
-                 # Set gradient steps and num_search
-                gd_steps_if_optim = self.args.num_iters_optim // 2
-                num_search_if_optim = self.args.num_iters_optim * (1 + self.no_optimize)  # GD steps take ca 2x as long as forward passes
-                # Optionally only optimize if at maximum query size
-                if self.args.only_optim_biggest:
-                    if len(query) < max_query_size:
-                        gd_steps = 0
-                        num_search = 1
-                    else:
-                        gd_steps = gd_steps_if_optim
-                        num_search = num_search_if_optim
-                else:
-                    gd_steps = gd_steps_if_optim
-                    num_search = num_search_if_optim
-
                 # Random search
                 objective, optimal_weights, feature_exps = \
                     self.random_search(desired_outputs, query, num_search, model, log_prior, mdp, true_reward_matrix)
@@ -368,6 +633,81 @@ class Query_Chooser(object):
 
         return best_query, best_optimal_weights, best_feature_exps
 
+    def find_next_feature_batched(self, curr_query, curr_weights, measure, max_query_size):
+        """Same as find_next_feature, but plans for and optimizes the queries curr_query + [feature] for all remaining
+        features together in one batched model. The gradient of the summed objectives is the gradient of each
+        candidate's own objective w.r.t. its own weights, so the optimization is the same as one at a time.
+
+        :return: List of candidate queries and, per candidate, the objective, optimized weights and feature exps.
+        """
+        mdp = self.inference.mdp
+        desired_outputs = [measure, 'weights_to_train', 'feature_exps']
+        features = [i for i in range(self.args.feature_dim) if i not in curr_query]
+        queries = [curr_query + [feature] for feature in features]
+        model = self.get_model(
+            len(curr_query) + 1, measure, discrete=False, optimize=True, batch_size=len(features))
+        model.initialize(self.sess)
+        true_reward_matrix, log_prior = self.get_true_reward_space()
+        self.optim_diff = []
+        ent = -np.dot(np.exp(log_prior), log_prior)
+        lr = ent.round(0) if ent > 1 else ent.round(1)
+        gd_steps, num_search = self.get_optimization_steps(len(curr_query) + 1, max_query_size)
+
+        if not self.search:
+            num_fixed = self.args.feature_dim - len(curr_query) - 1
+            weights = [self.get_weight_inits(curr_weights, i, num_fixed) for i in range(len(features))]
+            # Without inits, continue from the current weights of the model
+            if weights[0] is None:
+                weights = None
+            objectives, optimal_weights, feature_exps = model.compute(
+                desired_outputs, self.sess, mdp, queries, log_prior,
+                weights, gradient_steps=gd_steps, lr=lr,
+                true_reward_matrix=true_reward_matrix)
+        else:
+            search_model = self.get_model(len(curr_query) + 1, measure, discrete=False, optimize=True)
+            search_model.initialize(self.sess)
+            search_results = [
+                self.random_search(desired_outputs, query, num_search, search_model, log_prior, mdp, true_reward_matrix)
+                for query in queries]
+            objectives_search, optimal_weights, feature_exps = [np.array(result) for result in zip(*search_results)]
+            objectives = objectives_search
+
+            # Optimize from the best sample of each candidate if desired
+            if not self.no_optimize:
+                objectives, optimal_weights, feature_exps = model.compute(
+                    desired_outputs, self.sess, mdp, queries, log_prior,
+                    optimal_weights, gradient_steps=gd_steps, lr=lr,
+                    true_reward_matrix=true_reward_matrix)
+            self.optim_diff = list(objectives[:, 0, 0] - objectives_search[:, 0, 0])
+
+        return queries, objectives, optimal_weights, feature_exps
+
+    def get_optimization_steps(self, query_size, max_query_size):
+        """Returns the number of gradient steps and of random search samples for finding the weights of a feature
+        query of size query_size."""
+        # Optionally only optimize if at maximum query size
+        optimize_size = not (self.args.only_optim_biggest and query_size < max_query_size)
+        if not self.search:
+            if self.no_optimize or not optimize_size:
+                return 0, 0
+            return self.args.num_iters_optim, 0
+        if not optimize_size:
+            return 0, 1
+        # GD steps take ca 2x as long as forward passes
+        return self.args.num_iters_optim // 2, self.args.num_iters_optim * (1 + self.no_optimize)
+
+    def get_weight_inits(self, curr_weights, i, num_fixed):
+        """Returns the initial weights of the num_fixed non-query features when adding the i-th remaining feature, or
+        None to start from the current weights of the model."""
+        if not self.init_none:
+            if curr_weights is not None:
+                return list(curr_weights[:i]) + list(curr_weights[i+1:])
+            return None
+        elif self.zeros:
+            return list(np.zeros(num_fixed))
+        # Initialize with random weights
+        return self.sample_weights('init', num_fixed)
+
     # @profile
     def find_feature_query_greedy(self, query_size, measure, true_reward, random_query=False):
         """Returns feature query of size query_size that minimizes the objective (e.g. posterior entropy)."""
@@ -389,7 +729,7 @@ class Query_Chooser(object):
         desired_outputs = [measure, 'true_log_posterior', 'true_entropy', 'post_avg']
         true_reward_matrix, log_prior = self.get_true_reward_space(no_subsampling=True)
 
-        time_last_query_found = time.clock()
+        time_last_query_found = time.perf_counter()
 
         disc_size = self.args.discretization_size_human
         model = self.get_model(query_size, measure, discrete=False, discretization_size=disc_size, optimize=True)
@@ -427,6 +767,8 @@ class Query_Chooser(object):
 
     def random_search(self, desired_outputs, query, num_search, model, log_prior, mdp, true_reward_matrix):
         """Returns the objective, weights, and feature expectations that minimized the objective in a random search."""
+        if self.args.search_batch_size:
+            return self.random_search_batched(desired_outputs, query, num_search, log_prior, mdp, true_reward_matrix)
         best_objective_disc = float("inf")
         for _ in range(num_search):
             num_fixed = self.args.feature_dim - len(query)
@@ -447,6 +789,35 @@ class Query_Chooser(object):
 
         return best_objective_disc, best_optimal_weights_disc, best_feature_exps_disc
 
+    def random_search_batched(self, desired_outputs, query, num_search, log_prior, mdp, true_reward_matrix):
+        """Same as random_search, but plans for and scores up to args.search_batch_size weight samples per run of a
+        batched model. Draws the same samples and breaks ties the same way (last minimum)."""
+        num_fixed = self.args.feature_dim - len(query)
+        samples = np.array([self.sample_weights('search', num_fixed) for _ in range(num_search)])
+        batch_size = min(self.args.search_batch_size, num_search)
+        model = self.get_model(
+            len(query), desired_outputs[0], discrete=False, optimize=True, batch_size=batch_size)
+        model.initialize(self.sess)
+
+        best_objective_disc = float("inf")
+        for start in range(0, num_search, batch_size):
+            batch = samples[start:start + batch_size]
+            num_samples = len(batch)
+            # Fill up the last batch by repeating its last sample
+            batch = np.concatenate([batch, np.repeat(batch[-1:], batch_size - num_samples, axis=0)])
+            objectives_disc, weights_disc, feature_exps_disc = model.compute(
+                desired_outputs, self.sess, mdp, query, log_prior,
+                batch, true_reward_matrix=true_reward_matrix)
+
+            objectives = objectives_disc.reshape(-1)[:num_samples]
+            best = num_samples - 1 - np.argmin(objectives[::-1])
+            if objectives_disc[best] <= best_objective_disc:
+                best_objective_disc = objectives_disc[best]
+                best_optimal_weights_disc = weights_disc[best]
+                best_feature_exps_disc = feature_exps_disc[best]
+
+        return best_objective_disc, best_optimal_weights_disc, best_feature_exps_disc
+
     def get_other_weights_samples(self, length):
         """Generates random other weights from given discretization."""
         num_posneg_vals = (self.args.discretization_size // 2)
@@ -500,42 +871,47 @@ class Query_Chooser(object):
             return [list(random_combination(self.inference.reward_space_proxy, query_size)) for _ in range(num_queries_max)]
         return [list(x) for x in combinations(self.inference.reward_space_proxy, query_size)]
 
-    def get_true_reward_space(self, no_subsampling=False):
+    def get_true_reward_space(self, no_subsampling=False, return_idx=False):
+        """Returns the (subsampled) true reward matrix and its log prior. If return_idx, also returns the indeces of
+        the subsample in inference.true_reward_matrix (None without subsampling)."""
         if self.args.subsampling and not no_subsampling:
             # num_subsamples = self.args.num_subsamples
             # Get true reward samples to optimize with
-            true_reward_matrix, log_prior = self.sample_true_reward_matrix()
+            true_reward_idx, log_prior = self.sample_true_reward_idx()
+            true_reward_matrix = self.inference.true_reward_matrix[true_reward_idx]
             # log_prior = np.log(np.ones(num_subsamples) / num_subsamples)
         else:
+            true_reward_idx = None
             true_reward_matrix = self.inference.true_reward_matrix
             log_prior = self.inference.log_prior
+        if return_idx:
+            return true_reward_matrix, log_prior, true_reward_idx
         return true_reward_matrix, log_prior
 
     def sample_true_reward_matrix(self, uniform_sampling=False):
+        true_reward_idx, log_prior = self.sample_true_reward_idx(uniform_sampling)
+        return self.inference.true_reward_matrix[true_reward_idx], log_prior
+
+    def sample_true_reward_idx(self, uniform_sampling=False):
+        """Samples indeces into inference.true_reward_matrix from the prior (or uniformly) and returns them with the
+        log prior of the sample."""
         num_subsamples = self.args.num_subsamples
-        if uniform_sampling:
-            probs = np.ones(len(self.inference.log_prior))
-            weighting = False
-        else:
-            log_probs = self.inference.log_prior
-            probs = np.exp(log_probs)
-            weighting = self.args.weighting
-        probs = probs / probs.sum()
-        choices = np.random.choice(self.args.size_true_space, p=probs, size=num_subsamples)
+        weighting = self.args.weighting and not uniform_sampling
         if weighting:
-            unique_sample_idx, counts = np.unique(choices, return_counts=True)
-
-
+            unique_sample_idx, counts = self.inference.sample_true_reward_idx(
+                num_subsamples, return_counts=True)
             weighted_probs = np.ones(len(counts)) * counts
             weighted_probs = weighted_probs / weighted_probs.sum()
-            return self.inference.true_reward_matrix[unique_sample_idx], np.log(weighted_probs)
+            return unique_sample_idx, np.log(weighted_probs)
         else:
+            choices = self.inference.sample_true_reward_idx(num_subsamples, uniform_sampling)
             unif_log_prior = np.log(np.ones(num_subsamples) / num_subsamples)
-            return self.inference.true_reward_matrix[choices], unif_log_prior
+            return choices, unif_log_prior
 
     def get_model(self, query_size, objective, num_unknown=None,
                   discrete=True, optimize=False, no_planning=False, cache=True, rational_planner=False,
-                  discretization_size=None):
+                  discretization_size=None, cache_likelihoods=False, batched=False, batch_size=None,
+                  multi_mdp=False):
         mdp = self.inference.mdp
         height, width = None, None
         # TODO: Replace mdp.type with self.args.mdp_type
@@ -552,12 +928,30 @@ class Query_Chooser(object):
         # true_reward_space_size = len(self.inference.true_reward_matrix)
         key = (no_planning, mdp.type, dim, gamma, query_size,
                discretization_size, true_reward_space_size, num_unknown, beta,
-               beta_planner, lr, discrete, optimize, height, width, num_iters, objective)
+               beta_planner, lr, discrete, optimize, height, width, num_iters, objective, cache_likelihoods,
+               batched, batch_size, multi_mdp)
         if key in self.model_cache:
             return self.model_cache[key]
 
         print('building model...')
-        if no_planning:
+        if no_planning and self.args.no_planning_backend == 'numpy':
+            model = NumpyNoPlanningModel(
+                dim, gamma, query_size, discretization_size,
+                true_reward_space_size, num_unknown, beta, beta_planner,
+                objective, lr, discrete, optimize, self.args,
+                cache_likelihoods=cache_likelihoods, batched=batched)
+        elif no_planning and batched:
+            model_class = BatchedCachedNoPlanningModel if cache_likelihoods else BatchedNoPlanningModel
+            model = model_class(
+                dim, gamma, query_size, discretization_size,
+                true_reward_space_size, num_unknown, beta, beta_planner,
+                objective, lr, discrete, optimize, self.args)
+        elif no_planning and cache_likelihoods:
+            model = CachedNoPlanningModel(
+                dim, gamma, query_size, discretization_size,
+                true_reward_space_size, num_unknown, beta, beta_planner,
+                objective, lr, discrete, optimize, self.args)
+        elif no_planning:
             model = NoPlanningModel(
                 dim, gamma, query_size, discretization_size,
                 true_reward_space_size, num_unknown, beta, beta_planner,
@@ -567,21 +961,32 @@ class Query_Chooser(object):
             model = BanditsModel(
                 dim, gamma, query_size, discretization_size,
                 true_reward_space_size, num_unknown, beta, beta_planner,
-                objective, lr, discrete, optimize, self.args)
+                objective, lr, discrete, optimize, self.args, batch_size=batch_size)
         elif mdp.type == 'gridworld':
-            model = GridworldModel(
+            model_class = MultiMdpGridworldModel if multi_mdp else GridworldModel
+            model = model_class(
                 dim, gamma, query_size, discretization_size,
                 true_reward_space_size, num_unknown, beta, beta_planner,
                 objective, lr, discrete, optimize, mdp.height, mdp.width,
-                num_iters, self.args)
+                num_iters, self.args, batch_size=batch_size)
         else:
             raise ValueError('Unknown model type: ' + str(mdp.type))
 
+        model.answer_random_state = self.answer_random_state
         if cache:
             self.model_cache[key] = model
             print('Model built and cached!')
+            if key in self.restored_model_weights:
+                model.initialize(self.sess)
+                self.sess.run(model.assign_op, feed_dict={model.weight_inputs: self.restored_model_weights.pop(key)})
         return model
 
+    def get_model_weights(self):
+        """Returns the weights_to_train of the initialized cached models by model key. Continuous models start from
+        these weights when they are computed without weight inits, so they are part of a checkpoint."""
+        return {key: self.sess.run(model.weights_to_train) for key, model in self.model_cache.items()
+                if getattr(model, 'initialized', False) and hasattr(model, 'weights_to_train')}
+
 
 
 class Experiment(object):
@@ -592,31 +997,67 @@ class Experiment(object):
         self.num_queries_max = num_queries_max
         self.choosers = choosers
         self.seed = SEED
-        self.t_0 = time.clock()
+        self.t_0 = time.perf_counter()
         self.query_chooser = Query_Chooser(num_queries_max, args, t_0=self.t_0)
         self.results = {}
         # Add variance
         self.measures = ['true_entropy','test_regret','norm post_avg-true','post_regret','perf_measure','std_proxy','mean_proxy','std_goal','mean_goal']
         self.cum_measures = ['cum_test_regret', 'cum_post_regret']
         curr_time = str(datetime.datetime.now())[:-6]
-        self.folder_name = curr_time + '-' + '-'.join([key+'='+str(val) for key, val in sorted(exp_params.items())])
+        self.folder_name = curr_time + '-' + get_params_name(exp_params)
         self.train_inferences = train_inferences
         self.test_inferences = test_inferences
         self.true_rewards = true_rewards
         self.prior_avg = prior_avg
+        # Optimal return of the true reward in each test or training MDP, see get_optimal_returns
+        self.optimal_returns = {}
+        # Checkpoint to continue from, see load_checkpoint
+        self.checkpoint = None
+        if args.num_workers > 1 and (args.checkpoint_every or args.resume):
+            raise ValueError('--checkpoint_every and --resume are only supported for serial runs (num_workers <= 1)')
+        if args.resume:
+            self.folder_name = os.path.basename(os.path.normpath(args.resume))
+            self.checkpoint = self.load_checkpoint()
 
     # @profile
     def get_experiment_stats(self, num_iter, num_experiments):
         self.results = {}
         post_exp_regret_measurements = []; post_regret_measurements = []
-        for exp_num in range(num_experiments):
-            self.run_experiment(num_iter, exp_num, num_experiments)
-            self.write_experiment_results_to_csv(exp_num, num_iter)
+        if self.query_chooser.args.num_workers > 1:
+            self.run_experiments_in_pool(num_iter, num_experiments)
+            for exp_num in range(num_experiments):
+                self.write_experiment_results_to_csv(exp_num, num_iter)
+        else:
+            start_exp_num = 0
+            if self.checkpoint is not None:
+                start_exp_num = self.restore_checkpoint()
+            for exp_num in range(start_exp_num, num_experiments):
+                self.run_experiment(num_iter, exp_num, num_experiments)
+                self.write_experiment_results_to_csv(exp_num, num_iter)
+                if self.query_chooser.args.checkpoint_every:
+                    self.save_checkpoint(exp_num + 1)
 
         self.write_mean_and_median_results_to_csv(num_experiments, num_iter)
 
         return self.results
 
+    def run_experiments_in_pool(self, num_iter, num_experiments):
+        """Runs the experiments in args.num_workers spawned processes and merges their results into self.results.
+
+        Each experiment runs in a fresh graph and session (see run_experiment_in_worker) seeded with SEED + exp_num,
+        so its results don't depend on the number of workers or on which experiments a worker ran before. They
+        differ from serial runs, where all experiments share one graph and random stream.
+        """
+        experiment_args = (self.true_rewards, self.query_size, self.num_queries_max, self.query_chooser.args,
+                           self.choosers, self.seed, self.train_inferences, self.test_inferences, self.prior_avg)
+        # Unlike multiprocessing.Pool, the executor raises instead of hanging if a worker dies
+        with ProcessPoolExecutor(self.query_chooser.args.num_workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=init_experiment_worker, initargs=(experiment_args,)) as executor:
+            futures = [executor.submit(run_experiment_in_worker, exp_num, num_iter, num_experiments)
+                       for exp_num in range(num_experiments)]
+            for future in futures:
+                self.results.update(future.result())
+
     # @profile
     def run_experiment(self, num_iter, exp_num, num_experiments):
         print("======================================================Experiment {n}/{N}===============================================================".format(n=exp_num + 1, N=num_experiments))
@@ -624,38 +1065,57 @@ class Experiment(object):
 
         # Set run parameters
         inference = self.train_inferences[exp_num]
-        seed(self.seed)
-        self.seed += 1
+        # A checkpoint within this experiment (see restore_checkpoint) has already restored the random states
+        checkpoint, self.checkpoint = self.checkpoint, None
+        if checkpoint is None:
+            seed(self.seed)
+            self.query_chooser.answer_random_state.seed(self.seed)
+            self.seed += 1
         true_reward = self.true_rewards[exp_num]
+        self.optimal_returns = {}
+        checkpoint_every = self.query_chooser.args.checkpoint_every
 
         # Cache feature_exps for discrete experiments
         cache_feature_exps = any(chooser in self.choosers for chooser in ['greedy_discrete','exhaustive','random','full'])
         self.query_chooser.set_inference(inference, cache_feature_exps=cache_feature_exps)
 
         # Run experiment for each query chooser
-        for chooser in self.choosers:
+        for chooser_idx, chooser in enumerate(self.choosers):
+            if checkpoint is not None and chooser_idx < checkpoint['chooser_idx']:
+                continue
             print("===========================Experiment {n}/{N} for {chooser}===========================".format(chooser=chooser,n=exp_num+1,N=num_experiments))
-            inference.reset_prior()
+            first_iter = -1
+            if checkpoint is not None and chooser_idx == checkpoint['chooser_idx']:
+                inference.set_prior_state(checkpoint['prior_state'])
+                first_iter = checkpoint['iteration'] + 1
+                print('Resuming from iteration {i}'.format(i=first_iter + 1))
+            else:
+                inference.reset_prior()
 
-            for i in range(-1,num_iter):
-                iter_start_time = time.clock()
+            for i in range(first_iter,num_iter):
+                iter_start_time = time.perf_counter()
                 print("==========Iteration: {i}/{m} ({c}). Total time: {t}==========".format(i=i+1,m=num_iter,c=chooser,t=iter_start_time-self.t_0))
                 if i > -1:
                     query, perf_measure, true_log_posterior, true_entropy, post_avg, time_last_query_found \
                         = self.query_chooser.find_query(self.query_size, chooser, true_reward)
                     # query = [np.array(proxy) for proxy in query]    # unnecessary?
                     inference.update_prior(None, None, true_log_posterior)
+                    args = self.query_chooser.args
+                    if args.prune_prior_eps or args.prune_prior_top_k:
+                        inference.prune_prior(args.prune_prior_eps, args.prune_prior_top_k)
+                        print('Pruned prior to {n} true rewards. Discarded mass: {m}'.format(
+                            n=len(inference.log_prior), m=inference.discarded_mass))
                 # Log outcomes before 1st query
                 else:
                     query = None
-                    true_entropy = np.log(len(inference.prior))
+                    true_entropy = np.log(len(inference.log_prior))
                     perf_measure = float('inf')
                     post_avg = self.prior_avg
                     time_last_query_found = iter_start_time
 
 
                 # Outcome measures
-                iter_end_time = time.clock()
+                iter_end_time = time.perf_counter()
                 duration_iter = iter_end_time - iter_start_time
                 duration_query_chooser = time_last_query_found - iter_start_time
                 # post_exp_regret = self.query_chooser.get_exp_regret_from_query(query=[])
@@ -681,26 +1141,74 @@ class Experiment(object):
                     = true_entropy, perf_measure, post_regret, test_regret, norm_to_true, query, duration_iter, duration_query_chooser, \
                         std_proxy, mean_proxy, std_goal, mean_goal
 
-    def get_posterior_variance(self, inference):
-        """Gets posterior mean and std for last and 2nd last feature by sampling."""
-        args = self.query_chooser.args
-        feature_dim = args.feature_dim
-        # query_matrix_sample, log_prior_sample = self.query_chooser.sample_true_reward_matrix()
-        log_probs = inference.log_prior
-        probs = np.exp(log_probs)
-        probs = probs / probs.sum()
-        choices = np.random.choice(args.size_true_space, p=probs, size=50000)
-        # unif_log_prior = np.log(np.ones(10000) / 10000)
+                if checkpoint_every and (i + 2) % checkpoint_every == 0 and i + 1 < num_iter:
+                    self.save_checkpoint(exp_num, chooser_idx, i, inference)
 
-        posterior_samples = inference.true_reward_matrix[choices]
-        std = np.std(posterior_samples, 0)
-        means = np.mean(posterior_samples, 0)
+        if self.query_chooser.args.planning_cache_size:
+            print('Planning cache: {h} hits, {m} misses'.format(
+                h=self.query_chooser.planning_cache_hits, m=self.query_chooser.planning_cache_misses))
 
-        unique_sample_idx, counts = np.unique(choices, return_counts=True)
+    def get_checkpoint_path(self):
+        return 'data/' + self.folder_name + '/checkpoint.pkl'
 
+    def save_checkpoint(self, exp_num, chooser_idx=None, iteration=None, inference=None):
+        """Atomically writes the results so far and the random states to the experiment folder. If chooser_idx is
+        None, the checkpoint is taken before experiment exp_num. Otherwise it is taken after the given iteration of
+        the chooser and also holds the prior of inference.
+        """
+        checkpoint = {
+            'choosers': self.choosers,
+            'exp_num': exp_num,
+            'chooser_idx': chooser_idx,
+            'iteration': iteration,
+            'prior_state': None if inference is None else inference.get_prior_state(),
+            'results': self.results,
+            'seed': self.seed,
+            'python_random_state': getstate(),
+            'numpy_random_state': np.random.get_state(),
+            'answer_random_state': self.query_chooser.answer_random_state.get_state(),
+            'model_weights': self.query_chooser.get_model_weights(),
+        }
+        write_atomically(self.get_checkpoint_path(), lambda f: pickle.dump(checkpoint, f, pickle.HIGHEST_PROTOCOL))
+        print('Saved checkpoint to {path}'.format(path=self.get_checkpoint_path()))
+
+    def load_checkpoint(self):
+        with open(self.get_checkpoint_path(), 'rb') as f:
+            checkpoint = pickle.load(f)
+        if checkpoint['choosers'] != self.choosers:
+            raise ValueError('Checkpoint was saved with choosers {c}'.format(c=checkpoint['choosers']))
+        return checkpoint
+
+    def restore_checkpoint(self):
+        """Restores the results and random states of self.checkpoint and returns the experiment to continue with.
+        The checkpoint is kept in self.checkpoint only if it was taken within that experiment.
+
+        Answers are sampled from the query chooser's answer_random_state, which is restored too. Continuous models
+        without weight inits continue from their current weights, so the weights of the cached models are restored
+        when they are built again (see Query_Chooser.get_model). Models first built after the checkpoint draw the same
+        initial weights as in an uninterrupted run, since their random op has a fixed seed. So a resumed run gives the
+        same results as an uninterrupted one, up to how TF rounds the graphs of continuous models built in another
+        order.
+        """
+        checkpoint = self.checkpoint
+        self.results = checkpoint['results']
+        self.seed = checkpoint['seed']
+        setstate(checkpoint['python_random_state'])
+        np.random.set_state(checkpoint['numpy_random_state'])
+        self.query_chooser.answer_random_state.set_state(checkpoint['answer_random_state'])
+        self.query_chooser.restored_model_weights = dict(checkpoint['model_weights'])
+        if checkpoint['chooser_idx'] is None:
+            self.checkpoint = None
+        print('Resuming {folder} at experiment {n}'.format(folder=self.folder_name, n=checkpoint['exp_num'] + 1))
+        return checkpoint['exp_num']
+
+    def get_posterior_variance(self, inference):
+        """Gets posterior mean and std for last and 2nd last feature."""
+        feature_dim = self.query_chooser.args.feature_dim
         proxy_idx = feature_dim-2
         goal_idx = feature_dim-1
-        return std[proxy_idx], means[proxy_idx], std[goal_idx], means[goal_idx]
+        means, std = inference.get_prior_moments([proxy_idx, goal_idx])
+        return std[0], means[0], std[1], means[1]
 
     def compute_regret(self, post_avg, true_reward, inference=None):
         """Computes mean regret from optimizing post_avg across some cached test environments.
@@ -713,17 +1221,18 @@ class Experiment(object):
         else:
             inferences = [inference]
 
-        regrets = np.empty(len(self.test_inferences))
+        if self.query_chooser.args.regret_mdp_chunk_size and inferences[0].mdp.type == 'gridworld':
+            return self.compute_regret_multi_mdp(post_avg, true_reward, inferences)
+
+        optimal_rewards = self.get_optimal_returns(true_reward, inferences)
+        regrets = np.empty(len(inferences))
         for i, inference in enumerate(inferences):
             # New method using TF:
             test_mdp = inference.mdp
-            planning_model = self.query_chooser.get_model(1, 'entropy',
-                rational_planner=self.query_chooser.args.rational_test_planner)
+            post_avg_feature_exps = self.query_chooser.plan_for_reward(
+                post_avg, test_mdp, rational_planner=self.query_chooser.args.rational_test_planner)
 
-            [post_avg_feature_exps] = planning_model.compute(['feature_exps'], self.query_chooser.sess, test_mdp, [list(post_avg)])
-            [true_reward_feature_exps] = planning_model.compute(['feature_exps'], self.query_chooser.sess, test_mdp, [list(true_reward)])
-
-            optimal_reward = np.dot(true_reward_feature_exps, true_reward)
+            optimal_reward = optimal_rewards[i]
             test_reward = np.dot(post_avg_feature_exps, true_reward)
             regret = optimal_reward - test_reward
             regrets[i] = regret
@@ -741,6 +1250,52 @@ class Experiment(object):
                 print('regret: ' + str(regret) + text)
         return regrets.mean()
 
+    def compute_regret_multi_mdp(self, post_avg, true_reward, inferences):
+        """Same as compute_regret, but plans for post_avg in args.regret_mdp_chunk_size MDPs at a time with a
+        MultiMdpGridworldModel."""
+        mdps = [inference.mdp for inference in inferences]
+        regrets = self.get_optimal_returns(true_reward, inferences) - np.dot(
+            self.plan_in_mdps(post_avg, mdps), true_reward)
+        if regrets.min() < -1:
+            text = ' (post_regret)' if len(inferences) == 1 else ' (test_regret)'
+            print('Negative regret !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!')
+            print('regret: ' + str(regrets.min()) + text)
+        return regrets.mean()
+
+    def plan_in_mdps(self, reward, mdps):
+        """Returns the feature expectations of the test planner for reward in each of the gridworlds mdps, planning in
+        args.regret_mdp_chunk_size of them per run."""
+        planning_model = self.query_chooser.get_model(1, 'entropy',
+            rational_planner=self.query_chooser.args.rational_test_planner, multi_mdp=True)
+        chunk_size = self.query_chooser.args.regret_mdp_chunk_size
+        feature_exps = []
+        for start in range(0, len(mdps), chunk_size):
+            [chunk_feature_exps] = planning_model.compute(
+                ['feature_exps'], self.query_chooser.sess, mdps[start:start + chunk_size], [list(reward)])
+            feature_exps.append(chunk_feature_exps[:, 0])
+        return np.concatenate(feature_exps)
+
+    def get_optimal_returns(self, true_reward, inferences):
+        """Returns the return of the test planner for true_reward in the MDP of each inference.
+
+        The returns only depend on the MDP, the true reward and the planner, so they are cached for the experiment and
+        shared between test and post regret.
+        """
+        args = self.query_chooser.args
+        planner_settings = (args.rational_test_planner, args.gamma, args.beta_planner, args.value_iters,
+                            args.value_iters_tolerance)
+        keys = [(id(inference.mdp), tuple(true_reward), planner_settings) for inference in inferences]
+        missing = [inference for key, inference in zip(keys, inferences) if key not in self.optimal_returns]
+        if missing and args.regret_mdp_chunk_size and missing[0].mdp.type == 'gridworld':
+            feature_exps = self.plan_in_mdps(true_reward, [inference.mdp for inference in missing])
+        else:
+            feature_exps = [self.query_chooser.plan_for_reward(
+                true_reward, inference.mdp, rational_planner=args.rational_test_planner) for inference in missing]
+        for inference, inference_feature_exps in zip(missing, feature_exps):
+            key = (id(inference.mdp), tuple(true_reward), planner_settings)
+            self.optimal_returns[key] = np.dot(inference_feature_exps, true_reward)
+        return np.array([self.optimal_returns[key] for key in keys], dtype=np.float64).reshape(-1)
+
     def get_normalized_reward_diff(self, post_avg, true_reward):
         norm_post_avg = (post_avg - post_avg.mean())
         norm_post_avg = norm_post_avg / np.linalg.norm(norm_post_avg, ord=2)
@@ -861,3 +1416,25 @@ class Experiment(object):
             writer_sterr_all_choosers.writerow({'iteration': chooser})
             writer_sterr_all_choosers.writeheader()
             writer_sterr_all_choosers.writerows(rows_sterr)
+
+
+# Constructor arguments of the Experiment run by a worker process, set by init_experiment_worker
+worker_experiment_args = None
+
+def init_experiment_worker(experiment_args):
+    global worker_experiment_args
+    worker_experiment_args = experiment_args
+
+def run_experiment_in_worker(exp_num, num_iter, num_experiments):
+    """Runs experiment exp_num in a fresh graph with its own Query_Chooser (session and model cache) and returns its
+    results. Python, NumPy and TF are seeded with SEED + exp_num only."""
+    true_rewards, query_size, num_queries_max, args, choosers, SEED, train_inferences, test_inferences, prior_avg \
+        = worker_experiment_args
+    tf.compat.v1.reset_default_graph()
+    tf.compat.v1.set_random_seed(SEED + exp_num)
+    np.random.seed(SEED + exp_num)
+    experiment = Experiment(true_rewards, query_size, num_queries_max, args, choosers, SEED + exp_num, {},
+                            train_inferences, test_inferences, prior_avg)
+    experiment.run_experiment(num_iter, exp_num, num_experiments)
+    experiment.query_chooser.sess.close()
+    return experiment.results
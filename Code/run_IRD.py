@@ -1,8 +1,8 @@
 import time
-start = time.clock()
+start = time.perf_counter()
 
 import datetime
-from random import choice, seed
+from random import choice, seed, getstate, setstate
 import copy
 import sys
 import argparse
@@ -20,14 +20,40 @@ from gridworld import (
     GridworldMdp
 )
 from inference_class import Inference
-from utils import Distribution
+from env_bank import load_env_bank
+from utils import Distribution, load_true_reward_space
 
-print('Time to import: {deltat}'.format(deltat=time.clock() - start))
+print('Time to import: {deltat}'.format(deltat=time.perf_counter() - start))
 
 
-# ==================================================================================================== #
-# ==================================================================================================== #
-if __name__=='__main__':
+# Last value generated by get_cached for each name, with its key and the random states after generating it
+generated_values = {}
+
+
+def get_random_state():
+    """Returns the Python and NumPy random states in a form that can be compared and used as a dictionary key."""
+    _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return getstate(), (keys.tobytes(), pos, has_gauss, cached_gaussian)
+
+
+def get_cached(name, params, generate):
+    """Returns generate(), reusing the value of the previous call with the same name if params and the random states
+    agree. generate may draw from the Python and NumPy random streams: on a hit, the random states after generating
+    the value are restored, so later draws are the same as if generate had run. This lets repeated calls of main
+    in one process share the true reward space and environments.
+    """
+    key = (params, get_random_state())
+    if name not in generated_values or generated_values[name][0] != key:
+        value = generate()
+        generated_values[name] = key, value, getstate(), np.random.get_state()
+    _, value, python_state, numpy_state = generated_values[name]
+    setstate(python_state)
+    np.random.set_state(numpy_state)
+    return value
+
+
+def get_parser():
+    """Returns the parser of run_IRD.py's command line arguments."""
     parser = argparse.ArgumentParser()
 
     # args for experiment setup
@@ -44,6 +70,7 @@ if __name__=='__main__':
     parser.add_argument('--num_subsamples', type=int, default=10000)
     parser.add_argument('--weighting', type=int, default=1)
     parser.add_argument('--value_iters', type=int, default=15) # Max_reward / (1-gamma) or height+width
+    parser.add_argument('--value_iters_tolerance', type=float, default=0) # Stop value iteration once feature exps change less (0: always value_iters)
 
     parser.add_argument('--num_states', type=int, default=100)  # 10 options if env changes over time, 100 otherwise
     parser.add_argument('--linear_features', type=int, default=1)
@@ -54,6 +81,29 @@ if __name__=='__main__':
     parser.add_argument('--log_objective', type=int, default=1)
     parser.add_argument('--rational_test_planner', type=int, default=1)
     parser.add_argument('--well_spec', type=int, default=1) # default is well-specified
+    parser.add_argument('--cache_likelihoods', type=int, default=0) # Cache proxy x true reward matrix per inference (size_proxy x size_true floats)
+    parser.add_argument('--query_batch_size', type=int, default=0) # Evaluate this many candidate queries per session call (0: one at a time)
+    parser.add_argument('--no_planning_backend', type=str, default='tf') # 'tf' or 'numpy' for evaluating discrete queries
+    parser.add_argument('--incremental_greedy', type=int, default=0) # Score greedy single-proxy extensions from the current query's cached likelihoods (entropy objectives). Saves the exp/log work, not the O(query_size * size_true) matrix products
+    parser.add_argument('--lazy_greedy', type=int, default=0) # Re-evaluate only the top proxies of a heap of stale gains in greedy_discrete. Matches greedy only if gains don't increase as the query grows
+    parser.add_argument('--branch_and_bound', type=int, default=0) # Exhaustive chooser searches all combinations by branch and bound (entropy objective)
+    parser.add_argument('--bnb_max_nodes', type=int, default=1000000) # 0 for no limit
+    parser.add_argument('--bnb_max_seconds', type=float, default=600) # 0 for no limit
+    parser.add_argument('--search_batch_size', type=int, default=0) # Weight samples planned for in one run of random search (0: one at a time)
+    parser.add_argument('--batch_features', type=int, default=0) # Plan for and optimize all candidate features of feature queries together
+    parser.add_argument('--regret_mdp_chunk_size', type=int, default=0) # Test MDPs planned in one run when computing regret (0: one at a time)
+    parser.add_argument('--proxy_chunk_size', type=int, default=0) # Proxies planned for in one run when caching feature expectations, to bound memory (0: whole proxy space at once)
+    parser.add_argument('--prune_prior_eps', type=float, default=0) # Drop true rewards with posterior probability below this after each query (0: keep all)
+    parser.add_argument('--prune_prior_top_k', type=int, default=0) # Keep at most this many true rewards by posterior mass after each query (0: keep all)
+    parser.add_argument('--compact_dtypes', type=int, default=0) # Store true rewards as int8 and log priors as float32
+    parser.add_argument('--true_space_chunk_size', type=int, default=0) # NumPy backend streams over chunks of this many true rewards (0: whole space at once)
+    parser.add_argument('--num_workers', type=int, default=0) # Run experiments in this many processes (0 or 1: serially in this process)
+    parser.add_argument('--planning_cache_size', type=int, default=0) # Single-reward planning results kept in an LRU cache (0: no cache)
+    parser.add_argument('--feature_exps_cache_dir', type=str, default='') # Directory of proxy feature expectations cached per MDP ('': no disk cache)
+    parser.add_argument('--checkpoint_every', type=int, default=0) # Checkpoint to the experiment folder every this many iterations and after each experiment (0: never). Serial runs only (raises with num_workers > 1)
+    parser.add_argument('--resume', type=str, default='') # Experiment folder in data/ to continue from its checkpoint (same args otherwise)
+    parser.add_argument('--env_bank', type=str, default='') # .npz file of test and training MDPs written by env_bank.py ('': generate them)
+    parser.add_argument('--true_space_dir', type=str, default='') # Directory of memory-mapped true reward spaces shared between runs ('': generate in memory)
 
 
     # args for GridWorld
@@ -82,9 +132,49 @@ if __name__=='__main__':
     # args for testing full IRD
     parser.add_argument('--proxy_space_is_true_space', type=int, default=0)
     parser.add_argument('--full_IRD_subsample_belief', type=str, default='no')  # other options: yes, uniform
+    return parser
 
 
-    args = parser.parse_args()
+def get_exp_params(args):
+    """Returns the parameters that name the folder of a run's results (after its start time), see Experiment."""
+    exp_params = {
+        # 'rational_test_planner': args.rational_test_planner,
+        'qsize': args.query_size,
+        'mdp': args.mdp_type,
+        'dim': args.feature_dim,
+        'dsize': args.discretization_size,
+        'size_true': args.size_true_space,
+        'size_proxy': args.size_proxy_space,
+        'seed': args.seed,
+        'beta': args.beta,
+        'exp_name': args.exp_name,
+        # 'num_states': num_states,
+        'dist_scale': args.dist_scale,
+        # 'n_q_max': num_queries_max,
+        # 'num_iters_optim': num_iters_optim,
+        # 'well_spec': args.well_spec,
+        # 'subsamp': args.subsampling,
+        'num_subsamp': args.num_subsamples,
+        # 'weighting': args.weighting,
+        # 'viters': args.value_iters,
+        # 'linfeat': args.linear_features,
+        'objective': args.objective,
+        # 'w_dist_i': args.weights_dist_init,
+        # 'w_dist_s': args.weights_dist_search,
+        # 'optim_big': args.only_optim_biggest,
+        # 'rational_test': args.rational_test_planner
+        'proxy_is_true': args.proxy_space_is_true_space,
+        'full_IRD_subs': args.full_IRD_subsample_belief,
+        # 'corr_feat': args.repeated_obj,
+        # 'num_obj_if_corr': args.num_obj_if_repeated
+    }
+    return exp_params
+
+
+def main(args):
+    """Runs the experiments of the parsed command line arguments args and returns their results. Can be called
+    repeatedly in one process: each call builds its graphs in a fresh default graph and reuses the true reward
+    space and environments of the previous call if they agree (see get_cached)."""
     print(args)
     # assert args.discretization_size % 2 == 1
 
@@ -92,6 +182,7 @@ if __name__=='__main__':
     dummy_rewards = np.zeros(args.feature_dim)
     choosers = args.c
     SEED = args.seed
+    tf.compat.v1.reset_default_graph()
     seed(SEED)
     np.random.seed(SEED)
     tf.random.set_seed(SEED)
@@ -113,43 +204,22 @@ if __name__=='__main__':
     p_wall = 0.35 if args.height < 20 else 0.1
 
     # These will be in the folder name of the log
-    exp_params = {
-        # 'rational_test_planner': args.rational_test_planner,
-        'qsize': query_size,
-        'mdp': args.mdp_type,
-        'dim': args.feature_dim,
-        'dsize': args.discretization_size,
-        'size_true': size_reward_space_true,
-        'size_proxy': size_reward_space_proxy,
-        'seed': SEED,
-        'beta': beta,
-        'exp_name': args.exp_name,
-        # 'num_states': num_states,
-        'dist_scale': dist_scale,
-        # 'n_q_max': num_queries_max,
-        # 'num_iters_optim': num_iters_optim,
-        # 'well_spec': args.well_spec,
-        # 'subsamp': args.subsampling,
-        'num_subsamp': args.num_subsamples,
-        # 'weighting': args.weighting,
-        # 'viters': args.value_iters,
-        # 'linfeat': args.linear_features,
-        'objective': args.objective,
-        # 'w_dist_i': args.weights_dist_init,
-        # 'w_dist_s': args.weights_dist_search,
-        # 'optim_big': args.only_optim_biggest,
-        # 'rational_test': args.rational_test_planner
-        'proxy_is_true': args.proxy_space_is_true_space,
-        'full_IRD_subs': args.full_IRD_subsample_belief,
-        # 'corr_feat': args.repeated_obj,
-        # 'num_obj_if_corr': args.num_obj_if_repeated
-    }
+    exp_params = get_exp_params(args)
 
     # Sample True Reward Space
-    reward_space_true = np.array(
-        np.random.randint(-9, 10, size=[size_reward_space_true, args.feature_dim]), # Default - 1,000,000 arrays each containing 10 elements
-        dtype=np.int16
-    )
+    reward_dtype = np.int8 if args.compact_dtypes else np.int16
+    def generate_true_reward_space():
+        if args.true_space_dir:
+            return load_true_reward_space(
+                args.true_space_dir, SEED, size_reward_space_true, args.feature_dim, reward_dtype)
+        return np.array(
+            np.random.randint(-9, 10, size=[size_reward_space_true, args.feature_dim]), # Default - 1,000,000 arrays each containing 10 elements
+            dtype=reward_dtype
+        )
+    reward_space_true = get_cached('true_reward_space',
+                                   (size_reward_space_true, args.feature_dim, reward_dtype, args.true_space_dir),
+                                   generate_true_reward_space)
+    log_prior_dtype = np.float32 if args.compact_dtypes else np.float64
 
     # Sample True Rewards
     if not args.well_spec:
@@ -157,6 +227,9 @@ if __name__=='__main__':
             np.random.randint(-9, 10, size=[args.feature_dim]) for _ in range(num_experiments)
         )
     else:
+        if args.repeated_obj:
+            # The true rewards and the space are modified below, so they must not be views of the cached space
+            reward_space_true = np.array(reward_space_true)
         true_rewards = [choice(reward_space_true) for _ in range(num_experiments)]
         
         if args.repeated_obj: # for correlated features
@@ -172,98 +245,97 @@ if __name__=='__main__':
     # iniital prior reward associated with each feature
     prior_avg = -0.5 * np.ones(args.feature_dim) + 1e-4 * np.random.exponential(1,args.feature_dim) # post_avg for uniform prior + noise
     
-    # Set up env and agent for NStateMdp
-    if args.mdp_type == 'bandits':
-
-        # Create train and test MDPs
-        test_mdps = []
-        for i in range(args.num_test_envs):
-            mdp = NStateMdpGaussianFeatures(num_states=num_states, rewards=np.zeros(args.feature_dim), start_state=0, preterminal_states=[],
-                                            feature_dim=args.feature_dim, num_states_reachable=num_states, SEED=SEED+i*50+100)
-            test_mdps.append(mdp)
-
-        train_mdps = []
-        for i in range(num_experiments):
-            mdp = NStateMdpGaussianFeatures(num_states=num_states, rewards=np.zeros(args.feature_dim), start_state=0, preterminal_states=[],
-                                            feature_dim=args.feature_dim, num_states_reachable=num_states, SEED=SEED+i*50)
-            train_mdps.append(mdp)
-
-        # Create train and test inferences
-        test_inferences = []
-        for i in range(args.num_test_envs):
-            mdp = test_mdps[i]
-            env = GridworldEnvironment(mdp)
-            inference = Inference(
-                mdp, env, beta, reward_space_true, reward_space_proxy=[])
-
-            test_inferences.append(inference)
-
-        train_inferences = []
-        for i in range(num_experiments):
-            mdp = train_mdps[i]
-            env = GridworldEnvironment(mdp)
-            reward_space_proxy = reward_space_true if args.proxy_space_is_true_space \
-                else np.random.randint(-9, 10, size=[size_reward_space_proxy, args.feature_dim])
-            inference = Inference(
-                mdp, env, beta, reward_space_true, reward_space_proxy)
-
-            train_inferences.append(inference)
-
-
-    # Set up env and agent for gridworld
-    elif args.mdp_type == 'gridworld':
-        # Create train and test MDPs
-        test_inferences = []
-
-        for i in range(args.num_test_envs):
-
-            test_grid, test_goals = GridworldMdp.generate_random(
-                args,
-                height,
-                width,
-                0.35,
-                args.feature_dim,
-                None,
-                living_reward=-0.01,
-                print_grid=False,
-                decorrelate=args.decorrelate_test_feat
-            )
-            mdp = GridworldMdpWithDistanceFeatures(
-                test_grid,
-                test_goals,
-                args,
-                dist_scale,
-                living_reward=-0.01,
-                noise=0
-            )
-            env = GridworldEnvironment(mdp)
-
-            inference = Inference(
-                mdp,
-                env,
-                beta,
-                reward_space_true,
-                reward_space_proxy=[]
-            )
-
-            test_inferences.append(inference)
-
-
-        train_inferences = []
-        for j in range(num_experiments):
-            grid, goals = GridworldMdp.generate_random(args,height,width,0.35,args.feature_dim,None,living_reward=-0.01, print_grid=False)
-            mdp = GridworldMdpWithDistanceFeatures(grid, goals, args, dist_scale, living_reward=-0.01, noise=0)
-            env = GridworldEnvironment(mdp)
-            reward_space_proxy = reward_space_true if args.proxy_space_is_true_space \
-                else np.random.randint(-9, 10, size=[size_reward_space_proxy, args.feature_dim])
-            inference = Inference(
-                mdp, env, beta, reward_space_true, reward_space_proxy)
-
-            train_inferences.append(inference)
-
+    # Create train and test MDPs (and the proxy reward spaces of the train MDPs)
+    def generate_mdps():
+        proxy_spaces = []
+
+        if args.env_bank:
+            test_mdps, train_mdps = load_env_bank(args.env_bank, args)
+            for i in range(num_experiments):
+                proxy_spaces.append(None if args.proxy_space_is_true_space
+                                    else np.random.randint(-9, 10, size=[size_reward_space_proxy, args.feature_dim]))
+
+        # Set up env and agent for NStateMdp
+        elif args.mdp_type == 'bandits':
+            test_mdps = []
+            for i in range(args.num_test_envs):
+                mdp = NStateMdpGaussianFeatures(num_states=num_states, rewards=np.zeros(args.feature_dim), start_state=0, preterminal_states=[],
+                                                feature_dim=args.feature_dim, num_states_reachable=num_states, SEED=SEED+i*50+100)
+                test_mdps.append(mdp)
+
+            train_mdps = []
+            for i in range(num_experiments):
+                mdp = NStateMdpGaussianFeatures(num_states=num_states, rewards=np.zeros(args.feature_dim), start_state=0, preterminal_states=[],
+                                                feature_dim=args.feature_dim, num_states_reachable=num_states, SEED=SEED+i*50)
+                train_mdps.append(mdp)
+
+            for i in range(num_experiments):
+                proxy_spaces.append(None if args.proxy_space_is_true_space
+                                    else np.random.randint(-9, 10, size=[size_reward_space_proxy, args.feature_dim]))
+
+        # Set up env and agent for gridworld
+        elif args.mdp_type == 'gridworld':
+            test_mdps = []
+            for i in range(args.num_test_envs):
+
+                test_grid, test_goals = GridworldMdp.generate_random(
+                    args,
+                    height,
+                    width,
+                    0.35,
+                    args.feature_dim,
+                    None,
+                    living_reward=-0.01,
+                    print_grid=False,
+                    decorrelate=args.decorrelate_test_feat
+                )
+                mdp = GridworldMdpWithDistanceFeatures(
+                    test_grid,
+                    test_goals,
+                    args,
+                    dist_scale,
+                    living_reward=-0.01,
+                    noise=0
+                )
+                test_mdps.append(mdp)
+
+            train_mdps = []
+            for j in range(num_experiments):
+                grid, goals = GridworldMdp.generate_random(args,height,width,0.35,args.feature_dim,None,living_reward=-0.01, print_grid=False)
+                mdp = GridworldMdpWithDistanceFeatures(grid, goals, args, dist_scale, living_reward=-0.01, noise=0)
+                train_mdps.append(mdp)
+                proxy_spaces.append(None if args.proxy_space_is_true_space
+                                    else np.random.randint(-9, 10, size=[size_reward_space_proxy, args.feature_dim]))
+
+        else:
+            raise ValueError('Unknown MDP type: ' + str(args.mdp_type))
+
+        return test_mdps, train_mdps, proxy_spaces
+
+    mdp_params = (args.mdp_type, SEED, args.num_test_envs, num_experiments, num_states, height, width, args.feature_dim,
+                  dist_scale, args.decorrelate_test_feat, args.linear_features, args.repeated_obj,
+                  args.num_obj_if_repeated, size_reward_space_proxy, args.proxy_space_is_true_space, args.env_bank)
+    test_mdps, train_mdps, proxy_spaces = get_cached('mdps', mdp_params, generate_mdps)
+
+    # Create train and test inferences
+    test_inferences = []
+    for mdp in test_mdps:
+        env = GridworldEnvironment(mdp)
+        inference = Inference(
+            mdp, env, beta, reward_space_true, reward_space_proxy=[], log_prior_dtype=log_prior_dtype)
+
+        test_inferences.append(inference)
+
+    train_inferences = []
+    for mdp, reward_space_proxy in zip(train_mdps, proxy_spaces):
+        env = GridworldEnvironment(mdp)
+        if reward_space_proxy is None:
+            reward_space_proxy = reward_space_true
+        inference = Inference(
+            mdp, env, beta, reward_space_true, reward_space_proxy, log_prior_dtype=log_prior_dtype)
+
+        train_inferences.append(inference)
 
-    else:
-        raise ValueError('Unknown MDP type: ' + str(args.mdp_type))
 
 
 
@@ -282,7 +354,15 @@ if __name__=='__main__':
             prior_avg
         )
         results = experiment.get_experiment_stats(num_iter_per_experiment, num_experiments)
+        experiment.query_chooser.sess.close()
 
         print('__________________________Finished experiment__________________________')
+        return results
+
+    return run_experiment(query_size, train_inferences, test_inferences, true_rewards, prior_avg)
 
-    run_experiment(query_size, train_inferences, test_inferences, true_rewards, prior_avg)
+
+# ==================================================================================================== #
+# ==================================================================================================== #
+if __name__=='__main__':
+    main(get_parser().parse_args())
@@ -0,0 +1,222 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import run_IRD
+from query_chooser_class import Experiment, Query_Chooser
+
+
+# Small gridworld runs. Each test runs in a temporary directory, since results are written to data/.
+COMMON_ARGS = ['--num_experiments', '2', '--num_iter', '3', '--size_true_space', '200', '--size_proxy_space', '10',
+               '--num_test_envs', '2', '--height', '6', '--width', '6', '--feature_dim', '4', '--query_size', '2']
+TIME_MEASURES = ['time', 'time_query_chooser']
+
+
+class SimulatedKill(Exception):
+    pass
+
+
+class TestRunIRD(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def run_IRD(self, *args):
+        return run_IRD.main(run_IRD.get_parser().parse_args(COMMON_ARGS + list(args)))
+
+    def assert_same_results(self, results, other, rtol=0.):
+        """Checks that results and other agree on all measures except times, up to rtol for numbers."""
+        without_times = lambda r: {key: value for key, value in r.items() if key[1] not in TIME_MEASURES}
+        results, other = without_times(results), without_times(other)
+        self.assertEqual(sorted(results.keys()), sorted(other.keys()))
+        for key, value in results.items():
+            if rtol and value is not None:
+                np.testing.assert_allclose(value, other[key], rtol=rtol, atol=rtol, err_msg=str(key))
+            else:
+                np.testing.assert_equal(value, other[key], err_msg=str(key))
+
+    def test_cache_likelihoods(self):
+        args = ['-c', 'greedy_discrete', '-c', 'exhaustive']
+        self.assert_same_results(self.run_IRD(*(args + ['--cache_likelihoods', '1'])), self.run_IRD(*args))
+
+    def test_query_batch_size(self):
+        args = ['-c', 'greedy_discrete', '-c', 'exhaustive']
+        expected = self.run_IRD(*args)
+        # The batch size doesn't divide the number of candidate queries
+        for batch_args in [['--query_batch_size', '8'], ['--query_batch_size', '8', '--cache_likelihoods', '1']]:
+            self.assert_same_results(self.run_IRD(*(args + batch_args)), expected)
+
+    def test_search_batch_size(self):
+        args = ['-c', 'feature_entropy_search']
+        expected = self.run_IRD(*args)
+        # 3 doesn't divide the number of weight samples, so the last batch is padded
+        for batch_size in ['3', '4']:
+            self.assert_same_results(self.run_IRD(*(args + ['--search_batch_size', batch_size])), expected)
+
+    def test_batch_features(self):
+        args = ['-c', 'feature_entropy_search_then_optim', '--num_experiments', '1']
+        expected = self.run_IRD(*args)
+        for batch_args in [['--batch_features', '1'], ['--batch_features', '1', '--search_batch_size', '4']]:
+            # The batched model rounds differently in its planner and gradient steps
+            self.assert_same_results(self.run_IRD(*(args + batch_args)), expected, rtol=1e-4)
+
+    def test_regret_mdp_chunk_size(self):
+        args = ['-c', 'greedy_discrete', '--num_test_envs', '3']
+        expected = self.run_IRD(*args)
+        # The multi-MDP planner rounds differently in float32
+        for chunk_size in ['1', '2']:
+            self.assert_same_results(self.run_IRD(*(args + ['--regret_mdp_chunk_size', chunk_size])), expected,
+                                     rtol=1e-5)
+
+    def test_proxy_chunk_size(self):
+        args = ['-c', 'greedy_discrete', '-c', 'exhaustive']
+        expected = self.run_IRD(*args)
+        # 3 doesn't divide the size of the proxy space, so the last chunk is padded
+        for chunk_size in ['3', '4']:
+            self.assert_same_results(self.run_IRD(*(args + ['--proxy_chunk_size', chunk_size])), expected)
+
+    def test_optimal_returns_cache(self):
+        args = ['-c', 'greedy_discrete', '-c', 'random']
+        get_optimal_returns = Experiment.get_optimal_returns
+        def get_uncached_optimal_returns(experiment, *returns_args):
+            experiment.optimal_returns = {}
+            return get_optimal_returns(experiment, *returns_args)
+        with mock.patch.object(Experiment, 'get_optimal_returns', get_uncached_optimal_returns):
+            expected = self.run_IRD(*args)
+        self.assert_same_results(self.run_IRD(*args), expected)
+
+    def test_true_space_dir(self):
+        args = ['-c', 'greedy_discrete']
+        expected = self.run_IRD(*args)
+        # The first run writes the true reward space, the second one loads it instead of reusing it in memory
+        for _ in range(2):
+            run_IRD.generated_values.clear()
+            self.assert_same_results(self.run_IRD(*(args + ['--true_space_dir', 'true_spaces'])), expected)
+
+    def test_planning_cache_size(self):
+        # Both choosers plan for the prior mean before their first query, which the larger cache still holds
+        args = ['-c', 'greedy_discrete', '-c', 'random']
+        expected = self.run_IRD(*args)
+        for cache_size in ['1', '100']:
+            self.assert_same_results(self.run_IRD(*(args + ['--planning_cache_size', cache_size])), expected)
+
+    def test_get_cached(self):
+        generate = mock.Mock(side_effect=lambda: np.random.randint(10, size=3))
+        values, next_draws = [], []
+        for params in [1, 1, 2]:
+            np.random.seed(1)
+            values.append(run_IRD.get_cached('test', params, generate))
+            next_draws.append(np.random.randn(3))
+        # The second call reuses the value and restores the random state after generating it
+        self.assertEqual(generate.call_count, 2)
+        self.assertIs(values[1], values[0])
+        for value, draws in zip(values, next_draws):
+            np.testing.assert_array_equal(value, values[0])
+            np.testing.assert_array_equal(draws, next_draws[0])
+
+    def test_in_process_runs(self):
+        # Runs that reuse the spaces and environments of earlier runs match runs that generate them
+        repeated_obj = ['--repeated_obj', '1', '--num_obj_if_repeated', '6']
+        configs = [['-c', 'random'], ['-c', 'greedy_discrete', '--beta', '0.5'],
+                   ['-c', 'greedy_discrete'] + repeated_obj, ['-c', 'random'] + repeated_obj]
+        expected = []
+        for config in configs:
+            run_IRD.generated_values.clear()
+            expected.append(self.run_IRD(*config))
+        for config, config_expected in zip(configs, expected):
+            self.assert_same_results(self.run_IRD(*config), config_expected)
+
+    def test_resume(self):
+        # Kill the run after the checkpoints within and after the first experiment and within the second
+        self.check_resume(['-c', 'greedy_discrete', '-c', 'random', '--checkpoint_every', '2'], [1, 3, 4])
+        # Feature entropy continues from the weights its cached models were optimized to, also across experiments.
+        # The resumed run builds its models in another order, which TF's graph optimizations round differently.
+        self.check_resume(['-c', 'feature_entropy', '--only_optim_biggest', '0', '--checkpoint_every', '2'], [1, 2, 3],
+                          rtol=1e-4)
+
+    def check_resume(self, args, kill_after, rtol=0.):
+        """Checks that runs killed after each number of checkpoints in kill_after and then resumed give the results
+        of an uninterrupted run, up to rtol."""
+        expected = self.run_IRD(*(args + ['--exp_name', 'uninterrupted']))
+        for num_checkpoints in kill_after:
+            exp_name = 'killed{n}'.format(n=num_checkpoints)
+            save_checkpoint = Experiment.save_checkpoint
+            calls = []
+            def save_and_kill(experiment, *save_args, **save_kwargs):
+                save_checkpoint(experiment, *save_args, **save_kwargs)
+                calls.append(save_args)
+                if len(calls) == num_checkpoints:
+                    raise SimulatedKill()
+            with mock.patch.object(Experiment, 'save_checkpoint', save_and_kill):
+                with self.assertRaises(SimulatedKill):
+                    self.run_IRD(*(args + ['--exp_name', exp_name]))
+
+            folder, = [name for name in os.listdir('data') if exp_name in name]
+            results = self.run_IRD(*(args + ['--exp_name', exp_name, '--resume', os.path.join('data', folder)]))
+            self.assert_same_results(results, expected, rtol=rtol)
+        shutil.rmtree('data')
+
+    def test_feature_exps_cache(self):
+        args = ['-c', 'greedy_discrete', '--feature_exps_cache_dir', 'cache']
+        expected = self.run_IRD('-c', 'greedy_discrete')
+        # The first run fills the cache, the second one loads from it
+        for _ in range(2):
+            self.assert_same_results(self.run_IRD(*args), expected)
+            self.assertTrue(os.listdir('cache'))
+
+    def test_lazy_greedy(self):
+        # Every other true reward, so that the subsample differs from the whole space
+        def sample_true_reward_idx(query_chooser, uniform_sampling=False):
+            true_reward_idx = np.arange(0, len(query_chooser.inference.log_prior), 2)
+            return true_reward_idx, np.full(len(true_reward_idx), -np.log(len(true_reward_idx)))
+
+        # Lazy greedy only matches greedy if gains don't increase as the query grows, which holds for these bandits
+        args = ['-c', 'greedy_discrete', '--query_size', '4', '--mdp_type', 'bandits', '--num_states', '20']
+        with mock.patch.object(Query_Chooser, 'sample_true_reward_idx', sample_true_reward_idx):
+            expected = self.run_IRD(*args)
+            for lazy_args in [['--lazy_greedy', '1'], ['--lazy_greedy', '1', '--incremental_greedy', '1']]:
+                self.assert_same_results(self.run_IRD(*(args + lazy_args)), expected)
+
+    def test_lazy_greedy_subsample(self):
+        # The stale gains of lazy greedy are only bounds for the same objective, so each query uses one subsample
+        sample_true_reward_idx, build_discrete_query = Query_Chooser.sample_true_reward_idx, \
+            Query_Chooser.build_discrete_query
+        samples, samples_per_query = [], []
+        def sample_and_count(query_chooser, *args, **kwargs):
+            samples.append(args)
+            return sample_true_reward_idx(query_chooser, *args, **kwargs)
+        def build_and_count(query_chooser, *args, **kwargs):
+            num_samples = len(samples)
+            query = build_discrete_query(query_chooser, *args, **kwargs)
+            samples_per_query.append(len(samples) - num_samples)
+            return query
+
+        with mock.patch.object(Query_Chooser, 'sample_true_reward_idx', sample_and_count), \
+                mock.patch.object(Query_Chooser, 'build_discrete_query', build_and_count):
+            self.run_IRD('-c', 'greedy_discrete', '--query_size', '4', '--lazy_greedy', '1')
+        # One query per iteration of each experiment
+        self.assertEqual(samples_per_query, [1] * 6)
+
+    def test_num_workers(self):
+        # Each experiment is seeded on its own, so the results don't depend on how they are spread over the workers
+        args = ['-c', 'greedy_discrete', '--num_experiments', '3']
+        self.assert_same_results(self.run_IRD(*(args + ['--num_workers', '3'])),
+                                 self.run_IRD(*(args + ['--num_workers', '2'])))
+
+    def test_checkpoint_in_pool(self):
+        for args in [['--checkpoint_every', '2'], ['--resume', 'data/folder']]:
+            with self.assertRaises(ValueError):
+                self.run_IRD('-c', 'greedy_discrete', '--num_workers', '2', *args)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,6 @@
 from subprocess import call
+import argparse
+import traceback
 
 # Discrete experiments
 
@@ -16,6 +18,11 @@ rsize = '1000000'
 proxy_space_is_true_space = '0'
 exp_name = '14May_reward_hacking'
 
+# Set to a SweepScheduler to collect the commands of run() instead of running them one at a time
+scheduler = None
+# Set to True to run the commands of run() with run_IRD.main in this process instead of starting python for each
+in_process = False
+
 
 def run(chooser, qsize, mdp_type, num_iter, objective='entropy', discretization_size='5', discretization_size_human='5',
         viter='15', rsize=rsize, subsampling='1', proxy_space_is_true_space='0',
@@ -80,8 +87,19 @@ def run(chooser, qsize, mdp_type, num_iter, objective='entropy', discretization_
                '--num_obj_if_repeated', num_obj_if_repeated,
                '--decorrelate_test_feat', decorrelate_test_feat
                ]
-    print('Running command', ' '.join(command))
-    call(command)
+    if scheduler is not None:
+        scheduler.add_job(command)
+    elif in_process:
+        import run_IRD
+        print('Running in process', ' '.join(command))
+        try:
+            run_IRD.main(run_IRD.get_parser().parse_args(command[2:]))
+        except Exception:
+            # Like a failed subprocess, a failed run doesn't stop the sweep
+            traceback.print_exc()
+    else:
+        print('Running command', ' '.join(command))
+        call(command)
 
 
 # Run as usual
@@ -185,7 +203,26 @@ def run_continuous():
                     num_iter=num_iter)
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_jobs', type=int, default=0) # Runs at once with a SweepScheduler (0: one at a time, no ledger)
+    parser.add_argument('--cpus_per_job', type=int, default=1)
+    parser.add_argument('--cpu_budget', type=int, default=0) # CPUs for all running jobs (0: all CPUs)
+    parser.add_argument('--memory_per_job', type=float, default=4) # Estimated peak memory of a run in GB
+    parser.add_argument('--memory_budget', type=float, default=0) # GB for all running jobs (0: no limit)
+    parser.add_argument('--ledger', type=str, default='data/sweep_ledger.jsonl') # Record of started and finished runs for resuming
+    parser.add_argument('--in_process', type=int, default=0) # Run one at a time in this process, sharing TF, environments and reward spaces
+    args = parser.parse_args()
+    in_process = args.in_process
+    if args.num_jobs:
+        from sweep_scheduler import SweepScheduler
+        scheduler = SweepScheduler(args.ledger, args.num_jobs, cpu_budget=args.cpu_budget or None,
+                                   memory_budget=args.memory_budget or None, cpus_per_job=args.cpus_per_job,
+                                   memory_per_job=args.memory_per_job)
+
     # run_objectives()
     run_reward_hacking()
     run_continuous()
     run_discrete()
+
+    if scheduler is not None:
+        scheduler.run()
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import subprocess
+import time
+
+
+class SweepScheduler(object):
+    """Runs the run_IRD.py commands of a sweep as concurrent subprocesses within a CPU and memory budget.
+
+    Jobs are identified by their full command. Every start and finish is appended to a JSON-lines ledger, so a sweep
+    that was interrupted can be restarted with the same ledger: finished jobs are skipped and jobs that were running
+    are run again. Repeated commands run once. Each job's output goes to a log file in log_dir.
+    """
+    def __init__(self, ledger_path, max_jobs, cpu_budget=None, memory_budget=None, cpus_per_job=1, memory_per_job=0,
+                 log_dir='data/sweep_logs', poll_interval=5):
+        """
+        :param max_jobs: Maximum number of jobs running at once.
+        :param cpu_budget: Total CPUs of the running jobs (None: all CPUs of this machine).
+        :param memory_budget: Total estimated memory of the running jobs in GB (None: no limit).
+        :param cpus_per_job, memory_per_job: Defaults for the jobs' CPUs and estimated memory, see add_job.
+        """
+        self.ledger_path = ledger_path
+        self.max_jobs = max_jobs
+        self.cpu_budget = cpu_budget or multiprocessing.cpu_count()
+        self.memory_budget = memory_budget
+        self.cpus_per_job = cpus_per_job
+        self.memory_per_job = memory_per_job
+        self.log_dir = log_dir
+        self.poll_interval = poll_interval
+        self.jobs = []
+
+    def add_job(self, command, cpus=None, memory=None):
+        """Adds a run_IRD.py command (a list ['python', 'run_IRD.py', ...]) to the sweep.
+        :param cpus: Number of CPUs the job may use. Its TF and BLAS thread pools are limited to this.
+        :param memory: Estimated peak memory of the job in GB.
+        """
+        self.jobs.append({'command': command,
+                          'cpus': self.cpus_per_job if cpus is None else cpus,
+                          'memory': self.memory_per_job if memory is None else memory})
+
+    def get_job_key(self, job):
+        return ' '.join(job['command'])
+
+    def read_ledger(self):
+        """Returns the last recorded status of each job in the ledger."""
+        statuses = {}
+        if os.path.exists(self.ledger_path):
+            with open(self.ledger_path) as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        statuses[entry['job']] = entry['status']
+        return statuses
+
+    def write_ledger(self, job, status, **info):
+        entry = dict(job=self.get_job_key(job), status=status, time=time.time(), **info)
+        ledger_dir = os.path.dirname(self.ledger_path)
+        if ledger_dir and not os.path.exists(ledger_dir):
+            os.makedirs(ledger_dir)
+        with open(self.ledger_path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def get_pending_jobs(self):
+        """Returns the jobs that aren't recorded as done in the ledger, without repeated commands."""
+        statuses = self.read_ledger()
+        pending, keys = [], set()
+        for job in self.jobs:
+            key = self.get_job_key(job)
+            if statuses.get(key) == 'done':
+                print('Skipping finished ' + key)
+            elif key not in keys:
+                keys.add(key)
+                pending.append(job)
+        return pending
+
+    def fits(self, job, running):
+        """Checks if job fits into the budget next to the running jobs. A job always fits if nothing is running, so
+        that jobs larger than the budget still run (alone)."""
+        if not running:
+            return True
+        if len(running) >= self.max_jobs:
+            return False
+        if sum(other['cpus'] for other in running.values()) + job['cpus'] > self.cpu_budget:
+            return False
+        if self.memory_budget is not None and \
+                sum(other['memory'] for other in running.values()) + job['memory'] > self.memory_budget:
+            return False
+        return True
+
+    def start(self, job):
+        key = self.get_job_key(job)
+        if not os.path.exists(self.log_dir):
+            os.makedirs(self.log_dir)
+        log_path = os.path.join(self.log_dir, hashlib.sha1(key.encode()).hexdigest()[:12] + '.log')
+        env = dict(os.environ)
+        for name in ['TF_NUM_INTRAOP_THREADS', 'OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+            env[name] = str(job['cpus'])
+        env['TF_NUM_INTEROP_THREADS'] = '1'
+        print('Starting ' + key + ' (log: ' + log_path + ')')
+        with open(log_path, 'a') as log:
+            process = subprocess.Popen(job['command'], stdout=log, stderr=subprocess.STDOUT, env=env)
+        self.write_ledger(job, 'started', log=log_path)
+        return process
+
+    def run(self):
+        """Runs all pending jobs and returns the number of failed ones."""
+        pending = self.get_pending_jobs()
+        print('{n} of {N} jobs to run'.format(n=len(pending), N=len(self.jobs)))
+
+        running = {}
+        num_failed = 0
+        while pending or running:
+            while pending and self.fits(pending[0], running):
+                job = pending.pop(0)
+                running[self.start(job)] = job
+            time.sleep(self.poll_interval if running else 0)
+            for process, job in list(running.items()):
+                returncode = process.poll()
+                if returncode is None:
+                    continue
+                del running[process]
+                if returncode == 0:
+                    self.write_ledger(job, 'done')
+                else:
+                    num_failed += 1
+                    self.write_ledger(job, 'failed', returncode=returncode)
+                    print('Failed with return code {r}: '.format(r=returncode) + self.get_job_key(job))
+        return num_failed
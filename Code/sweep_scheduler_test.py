@@ -0,0 +1,47 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from sweep_scheduler import SweepScheduler
+
+
+def make_command(*args):
+    return ['python', 'run_IRD.py', '-c', 'greedy_discrete', '--query_size', '2'] + list(args)
+
+
+class TestSweepScheduler(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.scheduler = SweepScheduler(os.path.join(self.directory, 'ledger.jsonl'), max_jobs=2, cpu_budget=2,
+                                        log_dir=os.path.join(self.directory, 'logs'), poll_interval=0.01)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_pending_jobs(self):
+        # The commands share the results folder name, but only the first one finished
+        finished = make_command('--decorrelate_test_feat', '1')
+        other = make_command('--decorrelate_test_feat', '0')
+        for command in [finished, other, other]:
+            self.scheduler.add_job(command)
+        self.scheduler.write_ledger(self.scheduler.jobs[0], 'done')
+        self.assertEqual([job['command'] for job in self.scheduler.get_pending_jobs()], [other])
+
+    def test_run(self):
+        succeeding = [sys.executable, '-c', 'pass']
+        failing = [sys.executable, '-c', 'import sys; sys.exit(3)']
+        for command in [succeeding, failing, succeeding]:
+            self.scheduler.add_job(command)
+        self.assertEqual(self.scheduler.run(), 1)
+        statuses = self.scheduler.read_ledger()
+        self.assertEqual(statuses[' '.join(succeeding)], 'done')
+        self.assertEqual(statuses[' '.join(failing)], 'failed')
+
+        # Rerunning with the same ledger only runs the failed job
+        self.assertEqual([job['command'] for job in self.scheduler.get_pending_jobs()], [failing])
+
+
+if __name__ == '__main__':
+    unittest.main()
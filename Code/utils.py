@@ -1,3 +1,5 @@
+import os
+
 import numpy as np
 
 class Distribution(object):
@@ -53,3 +55,40 @@ class Distribution(object):
         return 'Distribution(%s)' % repr(self.dist)
 
 
+
+
+def load_true_reward_space(directory, seed, size, dim, dtype):
+    """Returns the true reward space drawn with np.random.randint(-9, 10, size=[size, dim]) right after seeding
+    np.random with seed. The space is written once to a .npy file in directory and memory-mapped (copy-on-write) by
+    every later run with the same (seed, size, dim, dtype), so that concurrent runs share it in the page cache. The
+    global numpy random state after drawing is stored next to it and restored on loading, so later draws are the
+    same as if the space had been generated.
+    """
+    name = 'true_rewards-seed={s}-size={n}-dim={d}-{t}'.format(s=seed, n=size, d=dim, t=np.dtype(dtype).name)
+    path = os.path.join(directory, name + '.npy')
+    state_path = os.path.join(directory, name + '-rng_state.npz')
+    if os.path.exists(path):
+        state = np.load(state_path)
+        np.random.set_state(('MT19937', state['keys'], int(state['pos']), int(state['has_gauss']),
+                             float(state['cached_gaussian'])))
+        return np.load(path, mmap_mode='c')
+
+    reward_space = np.array(np.random.randint(-9, 10, size=[size, dim]), dtype=dtype)
+    _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    # The state goes first because the space's file marks the pair as complete
+    write_atomically(state_path, lambda f: np.savez(
+        f, keys=keys, pos=pos, has_gauss=has_gauss, cached_gaussian=cached_gaussian))
+    write_atomically(path, lambda f: np.save(f, reward_space))
+    return np.load(path, mmap_mode='c')
+
+
+def write_atomically(path, write):
+    """Calls write on a temporary file next to path and renames it to path, so that concurrent runs never load a
+    partial file. Creates the directory if needed."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = '{p}.tmp{pid}'.format(p=path, pid=os.getpid())
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
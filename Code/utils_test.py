@@ -0,0 +1,39 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from utils import load_true_reward_space
+
+
+class TestLoadTrueRewardSpace(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_same_as_generated(self):
+        np.random.seed(3)
+        expected = np.random.randint(-9, 10, size=[100, 5]).astype(np.int16)
+        next_draws = np.random.randn(10)
+
+        # The first call writes the space, the second one memory-maps it
+        for _ in range(2):
+            np.random.seed(3)
+            reward_space = load_true_reward_space(self.directory, 3, 100, 5, np.int16)
+            self.assertEqual(reward_space.dtype, np.int16)
+            np.testing.assert_array_equal(reward_space, expected)
+            np.testing.assert_array_equal(np.random.randn(10), next_draws)
+        self.assertIsInstance(reward_space, np.memmap)
+
+        # Changes stay in memory (copy-on-write)
+        reward_space[0] = 0
+        np.testing.assert_array_equal(load_true_reward_space(self.directory, 3, 100, 5, np.int16), expected)
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()